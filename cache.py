@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Single-flight coalescing and LRU/TTL caching for subcoroutines.
+#
+# GNU LGPL v. 2.1
+
+import functools
+from collections import OrderedDict
+from coroutines import AsynchronousCall, Return, monotonic
+
+
+# Default maximum cached results per decorated coroutine
+CACHE_MAX_SIZE = 1024
+
+
+# Default cached result lifetime, seconds
+CACHE_TTL = 60.0
+
+
+# Separates positional and keyword arguments in keys,
+# so f( ('a', 1) ) and f( a = 1 ) differ
+KWARGS_MARK = object()
+
+
+
+class FlightAborted( Exception ):
+    """ Leader coroutine was closed before it returned a value """
+    def __init__( self, key ):
+        Exception.__init__( self, 'Single flight %r aborted.' % (key,) )
+
+
+
+class FlightWaiter( AsynchronousCall ):
+    def __init__( self, flight ):
+        AsynchronousCall.__init__( self )
+        self.flight = flight
+
+
+    def handle( self ):
+        # we're quiet :)
+        # Task will be scheduled by the flight leader
+        pass
+
+
+    # waiting task is cancelled
+    def cancel( self ):
+        self.flight.waiters.remove( self )
+
+
+
+# One in-flight execution,
+# shared by all callers with the same key.
+class Flight( object ):
+    def __init__( self ):
+        self.waiters = []
+
+
+    def land( self, result ):
+        waiters = self.waiters
+        self.waiters = None
+
+        # value or Exception
+        for w in waiters:
+            w.wakeup( result )
+
+
+
+# Usage:
+#   @singleFlight( maxSize = 100, ttl = 30 )
+#   def fetchConfig( key ):
+#       ...
+#       yield Return( config )
+#
+#   config = yield fetchConfig( 'db' )
+class SingleFlight( object ):
+    def __init__( self, func, maxSize = CACHE_MAX_SIZE, ttl = CACHE_TTL, key = None ):
+        self.func = func
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.keyFunc = key
+
+        self.cache = OrderedDict()  # key -> (expires, value), oldest first
+        self.flights = {}           # key -> Flight
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+
+    def makeKey( self, args, kwargs ):
+        if self.keyFunc is not None:
+            return self.keyFunc( *args, **kwargs )
+
+        if kwargs:
+            return args + ( KWARGS_MARK, ) + tuple( sorted(kwargs.iteritems()) )
+
+        return args
+
+
+    # Returns subcoroutine, so callers just yield it
+    def __call__( self, *args, **kwargs ):
+        return self.call( self.makeKey(args, kwargs), args, kwargs )
+
+
+    def call( self, key, args, kwargs ):
+        entry = self.cache.get( key )
+        if entry is not None:
+            expires, value = entry
+            if expires is None or expires > monotonic():
+                # move to the most recently used end
+                del self.cache[ key ]
+                self.cache[ key ] = entry
+                self.hits += 1
+                yield Return( value )
+
+            del self.cache[ key ]
+            self.expirations += 1
+
+        # somebody already works on it?
+        flight = self.flights.get( key )
+        if flight is not None:
+            self.coalesced += 1
+            waiter = FlightWaiter( flight )
+            flight.waiters.append( waiter )
+            # value or raises leader's exception
+            value = yield waiter
+            yield Return( value )
+
+        # we are the leader
+        self.misses += 1
+        flight = Flight()
+        self.flights[ key ] = flight
+        try:
+            value = yield self.func( *args, **kwargs )
+        except Exception, e:
+            del self.flights[ key ]
+            flight.land( e )
+            raise
+        except GeneratorExit:
+            del self.flights[ key ]
+            flight.land( FlightAborted(key) )
+            raise
+
+        del self.flights[ key ]
+        self.store( key, value )
+        flight.land( value )
+        yield Return( value )
+
+
+    def store( self, key, value ):
+        if self.maxSize <= 0 or (self.ttl is not None and self.ttl <= 0):
+            return
+
+        expires = None
+        if self.ttl is not None:
+            expires = monotonic() + self.ttl
+
+        self.cache[ key ] = (expires, value)
+        while len( self.cache ) > self.maxSize:
+            self.cache.popitem( last = False )
+            self.evictions += 1
+
+
+    def invalidate( self, key ):
+        self.cache.pop( key, None )
+
+
+    def clear( self ):
+        self.cache.clear()
+
+
+    def stats( self ):
+        return { 'size': len(self.cache),
+                 'inflight': len(self.flights),
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'coalesced': self.coalesced,
+                 'evictions': self.evictions,
+                 'expirations': self.expirations }
+
+
+    def __repr__( self ):
+        return 'SingleFlight( %s, %d of %d cached, %d in flight )' % \
+               (self.func.__name__, len(self.cache), self.maxSize, len(self.flights))
+
+
+
+# Decorator for coroutine functions.
+#
+# Concurrent calls with the same key share one execution,
+# results are kept in LRU cache for ttl seconds (ttl = None - forever).
+# Decorated function.flight is SingleFlight with stats().
+def singleFlight( maxSize = CACHE_MAX_SIZE, ttl = CACHE_TTL, key = None ):
+    def decorator( func ):
+        flight = SingleFlight( func, maxSize, ttl, key )
+
+        @functools.wraps( func )
+        def wrapper( *args, **kwargs ):
+            return flight( *args, **kwargs )
+
+        wrapper.flight = flight
+        return wrapper
+
+    return decorator
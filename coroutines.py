@@ -7,11 +7,80 @@
 # Kirill Kostuchenko <ddosoff@gmail.com>
 
 import sys
+import heapq
+import random
 import datetime
+import itertools
+import threading
 import traceback
+from functools import partial
 from collections import deque
 from types import GeneratorType
-from PyQt4.QtCore import QObject, QTimer, pyqtSignal, QCoreApplication
+from PyQt4.QtCore import QObject, QTimer, QEvent, pyqtSignal, QCoreApplication
+from metrics import SchedulerMetrics
+from exceptionsink import ExceptionSink
+
+
+
+# Monotonic clock, seconds: wall clock changes do not move it.
+# python 2 has no time.monotonic, call clock_gettime( CLOCK_MONOTONIC )
+# or QueryPerformanceCounter with ctypes.
+def loadMonotonic():
+    try:
+        from time import monotonic
+        return monotonic
+    except ImportError:
+        pass
+
+    import ctypes
+    import ctypes.util
+
+    if sys.platform == 'win32':
+        kernel32 = ctypes.windll.kernel32
+        frequency = ctypes.c_longlong()
+        kernel32.QueryPerformanceFrequency( ctypes.byref(frequency) )
+        frequency = float( frequency.value )
+
+
+        def monotonic():
+            counter = ctypes.c_longlong()
+            kernel32.QueryPerformanceCounter( ctypes.byref(counter) )
+            return counter.value / frequency
+
+
+        return monotonic
+
+
+    # libc of the process, librt of old glibc
+    clockGettime = None
+    for lib in ( None, ctypes.util.find_library('rt') ):
+        try:
+            clockGettime = ctypes.CDLL( lib, use_errno = True ).clock_gettime
+            break
+        except (OSError, AttributeError):
+            continue
+
+    if clockGettime is None:
+        raise ImportError( 'No monotonic clock: clock_gettime is not available' )
+
+    clockId = sys.platform == 'darwin' and 6 or 1   # CLOCK_MONOTONIC
+    # struct timespec, no argtypes: cheaper calls
+    timespec = ctypes.c_long * 2
+
+
+    def monotonic():
+        ts = timespec()
+        if clockGettime( clockId, ts ):
+            raise OSError( ctypes.get_errno(), 'clock_gettime failed' )
+        return ts[ 0 ] + ts[ 1 ] * 1e-9
+
+
+    monotonic()
+    return monotonic
+
+
+
+monotonic = loadMonotonic()
 
 
 # Reduce scheduler overhead
@@ -31,6 +100,33 @@ AVERAGE_SCHEDULER_TIME = datetime.timedelta( milliseconds = 30 )
 MAX_SCHEDULER_ITERATIONS = 10
 
 
+# Task may continue in place through Checkpoint traps this long
+TASK_TIME_SLICE = datetime.timedelta( milliseconds = 3 )
+
+
+# Look at the clock once per N Checkpoint traps
+CHECKPOINT_CLOCK_INTERVAL = 32
+
+
+# Task.run results
+STEP_YIELD = 0    # (yield), iteration limit or checkpoint. Run again later.
+STEP_CALL = 1     # yield AsynchronousCall(..), the call is Task.result
+STEP_DONE = 2     # task is over, done emitted
+STEP_WAIT = 3     # yield Future() or Parallel(), task is parked
+
+
+# Posted to Scheduler, when other threads have work for it
+EXTERNAL_EVENT = QEvent.Type( QEvent.registerEventType() )
+
+
+# Posted to Scheduler, when ready tasks wait for the next tick
+SCHEDULE_EVENT = QEvent.Type( QEvent.registerEventType() )
+
+
+# Posted to WaitSignal, delivers coalesced emissions
+SIGNAL_EVENT = QEvent.Type( QEvent.registerEventType() )
+
+
 
 # Usage: 
 #   yield Return( v1, v2, .. )
@@ -48,9 +144,31 @@ class Return( object ):
 
 
 
+# Cheap execution trap for tight loops.
+# Task.run continues in place, until scheduler time slice
+# is used up or qt events are pending.
+#
+# Usage:
+#   yield Checkpoint()
+class Checkpoint( object ):
+    __slots__ = ()
+
+
+
 # Inherit your asynchronous calls,
 # like Sleep below.
+#
+# inlineWakeup = True: wakeup() called inside handle() completes the call
+# inline, scheduler resumes the task in the same step. Otherwise the task
+# is resumed after Scheduler.schedule, like other wakeups.
 class AsynchronousCall( QObject ):
+    # set True to resume in the same step, when completed inside handle()
+    inlineWakeup = False
+
+    # dispatch() state
+    handling = False
+    completed = False
+
     def handle( self ):
         raise Exception( 'Not Implemented' )
     
@@ -61,6 +179,26 @@ class AsynchronousCall( QObject ):
         self.scheduler = scheduler
 
 
+    # will be called by scheduler.
+    # Returns True, if call completed inside handle()
+    def dispatch( self, task, scheduler ):
+        self.setContext( task, scheduler )
+        self.handling = True
+        self.completed = False
+        try:
+            self.handle()
+        finally:
+            self.handling = False
+
+        return self.completed
+
+
+    # Waiting task is cancelled, release timers, connections, etc.
+    # Late wakeup() is ignored by the scheduler.
+    def cancel( self ):
+        pass
+
+
     # continue execution
     def wakeup( self, result = None ):
         if isinstance( result, Exception ):
@@ -74,10 +212,23 @@ class AsynchronousCall( QObject ):
         else:
             self.task.sendval = result
 
+        # called from handle()? scheduler will resume the task itself
+        if self.handling and self.inlineWakeup:
+            self.completed = True
+            return
+
+        if self.scheduler.tracer is not None:
+            self.scheduler.tracer.wakeup( self.task, self.scheduler.task )
+
         # Wake up execution of the caller's task
         self.scheduler.schedule( self.task )
 
 
+    # continue execution, may be called from any thread
+    def wakeupThreadsafe( self, result = None ):
+        self.scheduler.scheduleThreadsafe( self.task, result )
+
+
 
 # Asynchronous call example
 #
@@ -103,12 +254,19 @@ class Sleep( AsynchronousCall ):
         self.wakeup( None )
 
 
+    def cancel( self ):
+        QObject.killTimer( self, self.timerId )
+
+
 
 # Wait task, until it's done!
 #
 # Usage:
 #   res = yield WaitTask( task )   # res - task return value or raises Exception from task
 class WaitTask( AsynchronousCall ):
+    # done tasks complete inside handle()
+    inlineWakeup = True
+
     def __init__( self, waitTask ):
         AsynchronousCall.__init__( self )
         # save params for the future use
@@ -116,13 +274,13 @@ class WaitTask( AsynchronousCall ):
 
 
     def handle( self ):
-        if self.waitTask.state == Task.RUNNING:
+        if self.waitTask.state in ( Task.NEW, Task.RUNNING ):
             # When task is done, it emits signal done(Return)
             self.waitTask.done.connect( self.passParam )
         elif self.waitTask.state == Task.DONE:
             # repeat last return value
             self.wakeup( self.waitTask.result.value )
-        elif self.waitTask.state == Task.EXCEPTION:
+        elif self.waitTask.state in ( Task.EXCEPTION, Task.CANCELLED ):
             # raise exception in the waiter
             self.wakeup( self.waitTask.exception )
         else:
@@ -134,27 +292,35 @@ class WaitTask( AsynchronousCall ):
         self.wakeup( resReturn.value )
 
 
+    def cancel( self ):
+        self.waitTask.done.disconnect( self.passParam )
+
+
 
 # Wait, until first task is done or Exception!
 #
 # Usage:
 #   task = WaitFirstTask( [task1, task2, ... ], [timeout] )
 class WaitFirstTask( AsynchronousCall ):
+    # done tasks complete inside handle()
+    inlineWakeup = True
+
     def __init__( self, iterableTasks, timeoutMs = 0 ):
         AsynchronousCall.__init__( self )
         # save params for the future use
         self.tasks = iterableTasks
         assert self.tasks
         self.timeoutMs = timeoutMs
+        self.timerId = None
 
 
     def handle( self ):
         connected = []
         for t in self.tasks:
-            if t.state == Task.RUNNING:
+            if t.state in ( Task.NEW, Task.RUNNING ):
                 t.done.connect( self.passParam )
                 connected.append( t )
-            elif t.state == Task.DONE or t.state == Task.EXCEPTION:
+            elif t.state in ( Task.DONE, Task.EXCEPTION, Task.CANCELLED ):
                 [u.done.disconnect( self.passParam ) for u in connected ]
                 self.wakeup( t )
                 return
@@ -171,6 +337,11 @@ class WaitFirstTask( AsynchronousCall ):
         for t in self.tasks:
             t.done.disconnect( self.passParam )
 
+        # do not wake up twice
+        if self.timerId is not None:
+            QObject.killTimer( self, self.timerId )
+            self.timerId = None
+
         # expand Return to it's value
         self.wakeup( self.sender() )
 
@@ -183,6 +354,202 @@ class WaitFirstTask( AsynchronousCall ):
         self.wakeup( None )
 
 
+    def cancel( self ):
+        for t in self.tasks:
+            t.done.disconnect( self.passParam )
+
+        if self.timerId is not None:
+            QObject.killTimer( self, self.timerId )
+            self.timerId = None
+
+
+
+# Wait for qt signal emission.
+# Returns signal arguments tuple or None on timeout.
+#
+# coalesce = True: emissions during one event loop pass wake the task once
+# with the latest arguments, or with the list of all arguments tuples, if keepAll.
+#
+# Usage:
+#   args = yield WaitSignal( reply.readyRead, 5000, coalesce = True )
+class WaitSignal( AsynchronousCall ):
+    def __init__( self, signal, timeoutMs = 0, coalesce = False, keepAll = False ):
+        AsynchronousCall.__init__( self )
+        # save params for the future use
+        self.signal = signal
+        self.timeoutMs = timeoutMs
+        self.coalesce = coalesce
+        self.keepAll = keepAll
+
+        self.connected = False
+        self.timerId = None
+        self.emissions = []    # coalesced arguments
+
+
+    def handle( self ):
+        self.signal.connect( self.emitted )
+        self.connected = True
+
+        # timoeut passed?
+        if self.timeoutMs:
+            self.timerId = QObject.startTimer( self, self.timeoutMs )
+
+
+    def emitted( self, *args ):
+        # queued emission after wakeup?
+        if not self.connected:
+            return
+
+        if not self.coalesce:
+            self.release()
+            self.wakeup( args )
+            return
+
+        # posted events are delivered after the current burst
+        if not self.emissions:
+            QCoreApplication.postEvent( self, QEvent(SIGNAL_EVENT) )
+        self.emissions.append( args )
+
+
+    def customEvent( self, e ):
+        if e.type() == SIGNAL_EVENT and self.emissions:
+            self.deliver()
+
+
+    def timerEvent( self, e ):
+        if self.emissions:
+            self.deliver()
+            return
+
+        self.release()
+        self.wakeup( None )
+
+
+    def cancel( self ):
+        self.emissions = []
+        self.release()
+
+
+    def deliver( self ):
+        emissions = self.emissions
+        self.emissions = []
+        self.release()
+        if self.keepAll:
+            self.wakeup( emissions )
+        else:
+            self.wakeup( emissions[ -1 ] )
+
+
+    # disconnect and stop timer, do not wake up twice
+    def release( self ):
+        if self.connected:
+            self.signal.disconnect( self.emitted )
+            self.connected = False
+
+        if self.timerId is not None:
+            QObject.killTimer( self, self.timerId )
+            self.timerId = None
+
+
+
+# Result shared by many waiters: tasks and plain python / qt code.
+# Waiting tasks are woken in one bulk schedule.
+# Not thread safe, use scheduler.callThreadsafe( future.setResult, v ).
+#
+# Usage:
+#   value = yield future                 # in coroutines, raises future exception
+#   future.addCallback( func )           # func( future ), when done
+#   future.setResult( value )            # or future.setException( e )
+class Future( object ):
+    # States
+    PENDING = 0
+    DONE = 1
+    EXCEPTION = 2
+
+    def __init__( self ):
+        self.state = Future.PENDING
+        self.value = None       # result or Exception
+        self.waiters = []       # parked tasks
+        self.callbacks = []
+
+
+    def done( self ):
+        return self.state != Future.PENDING
+
+
+    def result( self ):
+        assert self.state != Future.PENDING, "Can't get result of pending future"
+        if self.state == Future.EXCEPTION:
+            raise self.value
+        return self.value
+
+
+    def setResult( self, value = None ):
+        self.complete( Future.DONE, value )
+
+
+    def setException( self, e ):
+        if isinstance( e, CoException ):
+            e = e.orig
+        self.complete( Future.EXCEPTION, e )
+
+
+    def addCallback( self, func ):
+        if self.state == Future.PENDING:
+            self.callbacks.append( func )
+        else:
+            func( self )
+
+
+    # Called by Task.run, returns False, when task is parked
+    def resolve( self, task ):
+        if self.state == Future.PENDING:
+            self.waiters.append( task )
+            return False
+
+        self.deliver( task )
+        return True
+
+
+    # waiting task is cancelled
+    def discard( self, task ):
+        self.waiters.remove( task )
+
+
+    def deliver( self, task ):
+        if self.state == Future.EXCEPTION:
+            # own stack for every waiter
+            task.exception = CoException( self.value )
+        else:
+            task.sendval = self.value
+
+
+    def complete( self, state, value ):
+        assert self.state == Future.PENDING, 'Future is already done'
+
+        self.state = state
+        self.value = value
+
+        waiters = self.waiters
+        self.waiters = []
+        batches = {}
+        for t in waiters:
+            self.deliver( t )
+            batches.setdefault( t.scheduler, [] ).append( t )
+        for scheduler, tasks in batches.iteritems():
+            scheduler.scheduleMany( tasks )
+
+        callbacks = self.callbacks
+        self.callbacks = []
+        for func in callbacks:
+            func( self )
+
+
+    def __repr__( self ):
+        return 'Future( %s, %d waiters )' % \
+               (('PENDING', 'DONE', 'EXCEPTION')[ self.state ], len(self.waiters))
+
+
 
 # Exception with the coroutines stack
 class CoException( Exception ):
@@ -219,70 +586,88 @@ class CoException( Exception ):
         return self.__repr__()
 
 
-# Coroutine based task
-class Task( QObject ):
-    # Return.value is task result, if no unhandled Exceptions occured.
-    # Emmited on Exception with Exception as Return.value, if emitUnhandled set.
-    # Do not emmited with exception, if emitUnhandled is False. Pass exceptions to main loop.
-    done = pyqtSignal( Return )
-
+# Coroutines stack run by the scheduler: Task or its Parallel branch
+class Frame( object ):
     # States
     NEW = 0
     RUNNING = 1
     DONE = 2
     EXCEPTION = 3
+    CANCELLED = 4
+
+    # Parallel branch?
+    branch = False
 
     def stateStr( self ):
-        if self.state == Task.NEW:
+        if self.state == Frame.NEW:
             return 'NEW'
-        elif self.state == Task.RUNNING:
+        elif self.state == Frame.RUNNING:
             return 'RUNNING'
-        elif self.state == Task.DONE:
+        elif self.state == Frame.DONE:
             return 'DONE'
-        elif self.state == Task.EXCEPTION:
+        elif self.state == Frame.EXCEPTION:
             return 'EXCEPTION'
+        elif self.state == Frame.CANCELLED:
+            return 'CANCELLED'
         else:
             raise Exception( 'Unknown state %s' % self.state )
 
 
-    def __init__( self, parent, coroutine ):
-        QObject.__init__( self, parent )
-
-        self.state = Task.NEW
+    def initFrame( self, coroutine ):
+        self.tid = next( Task.ids )
+        self.created = monotonic()
+        self.state = Frame.NEW
         self.stack = deque()          # stack for subcoroutines
         self.coroutine = coroutine    # task coroutine / top subcoroutine
         self.sendval = None           # value to send into coroutine
         self.exception = None         # save exceptions here
         self.result = Return( None )  # default return value
-        # Do not route exceptions to Scheduler
-        self.emitUnhandled = False    # emits done with unhandled exception as Return.value
+        self.scheduler = None         # set by Scheduler.newTask
+        self.scheduledAt = 0          # last Scheduler.schedule time
+        self.group = None             # TaskGroup, set by Scheduler.newTask
+        self.waitingOn = None         # AsynchronousCall, Future or Parallel, while parked
+        self.waitingSince = 0
+
+
+    # Logical coroutines stack, [ (filename, line, function), .. ] from the task coroutine.
+    # Could be called from other threads.
+    def coroutineStack( self ):
+        res = []
+        for c in list( self.stack ) + [ self.coroutine ]:
+            frame = c.gi_frame
+            if frame is not None:
+                res.append( (c.gi_code.co_filename, frame.f_lineno, c.gi_code.co_name) )
+        return res
 
 
-    # Do not pass exceptions to scheduler.
-    #
-    # Useful with WaitTask of WaitFirstTask calls.
-    def setEmitUnhandled( self, val = True ):
-        self.emitUnhandled = val
+    def formatBacktrace( self ):
+        return ''.join( '  File "%s", line %d, in %s\n' % e for e in self.coroutineStack() )
 
 
-    def formatBacktrace( self ):
-        # TODO: implement full trace
-        return 'File "%s", line %d' % \
-               (self.coroutine.gi_code.co_filename, self.coroutine.gi_frame.f_lineno)
+    # Coroutine is over with self.result.
+    # Returns True, when the frame is over.
+    def finish( self ):
+        # old exceptions handled
+        self.exception = None
 
+        # end of frame?
+        if not self.stack:
+            self.completed()
+            return True
 
-    def val( self ):
-        if self.state == Task.DONE:
-            return self.result.value
-        if self.state == Task.EXCEPTION:
-            return self.exception.orig
-        else:
-            assert False, "Can't get result. State: %d" % self.state
+        # end of subcoroutine
+        self.sendval = self.result.value
+        del self.coroutine
+        self.coroutine = self.stack.pop()
+        return False
 
 
-    # Run a task until it hits the next yield statement
+    # Run a task until it hits the next yield statement.
+    # Returns STEP_* status, raises CoException on unhandled exceptions.
     def run( self ):
-        for i in xrange( MAX_TASK_ITERATIONS ):
+        i = 0
+        while i < MAX_TASK_ITERATIONS:
+            i += 1
             try:
                 if self.exception:
                     self.result = self.coroutine.throw( self.exception.orig )
@@ -294,47 +679,29 @@ class Task( QObject ):
                 # simple trap? (yield)
                 if self.result is None:
                     # go back to the scheduler
-                    return
-
-                # yield AsynchronousCall(..)
-                if isinstance( self.result, AsynchronousCall ): 
-                    # handled by scheduler
-                    return self.result
-
-                # yield subcoroutine(..)
-                if isinstance( self.result, GeneratorType ):
-                    # save current coroutine in stack
-                    self.stack.append( self.coroutine )
-                    self.coroutine = self.result
+                    return STEP_YIELD
+
+                # cheap trap? (yield Checkpoint())
+                if type( self.result ) is Checkpoint:
+                    if self.scheduler is None or self.scheduler.sliceExpired():
+                        return STEP_YIELD
+
+                    # continue in place, do not count iteration
                     self.sendval = None
+                    i -= 1
                     continue
-                
-                # yield Return(..)
-                if isinstance( self.result, Return ):
-                    raise StopIteration()
 
-                # Unknown result type!?
-                raise TypeError( '%s\n\nWrong type %s yielded.' % \
-                                 (self.formatBacktrace(), type(self.result)) )
+                handler = yieldHandlers.get( type(self.result) ) or findYieldHandler( self )
+                status = handler( self, self.result )
+                if status is not None:
+                    return status
 
             except StopIteration:
-                # old exceptions handled
-                self.exception = None
-
-                if not isinstance( self.result, Return ):
-                    # replace previous yield
-                    self.result = Return( None )
-
-                # end of task?
-                if not self.stack:
-                    self.state = Task.DONE
-                    self.done.emit( self.result )
-                    raise
-
-                # end of subcoroutine
-                self.sendval = self.result.value
-                del self.coroutine
-                self.coroutine = self.stack.pop()
+                # coroutine returned without Return(..)
+                # replace previous yield
+                self.result = Return( None )
+                if self.finish():
+                    return STEP_DONE
 
             except Exception, e:
                 if self.exception is None:
@@ -348,54 +715,861 @@ class Task( QObject ):
                 self.exception.updateStack()
 
                 if not self.stack:
-                    self.state = Task.EXCEPTION
-                    if self.emitUnhandled:
-                        self.done.emit( Return(self.exception) )
-                        raise StopIteration()
-                    else:
-                        raise self.exception
+                    return self.unhandled()
 
                 del self.coroutine
                 self.coroutine = self.stack.pop()
 
+        return STEP_YIELD
+
+
+
+# Coroutine based task
+class Task( QObject, Frame ):
+    # Return.value is task result, if no unhandled Exceptions occured.
+    # Emmited on Exception with Exception as Return.value, if emitUnhandled set.
+    # Do not emmited with exception, if emitUnhandled is False. Pass exceptions to main loop.
+    done = pyqtSignal( Return )
+
+    # Task.tid generator
+    ids = itertools.count( 1 )
+
+    def __init__( self, parent, coroutine ):
+        QObject.__init__( self, parent )
+        self.initFrame( coroutine )
+
+        self.admitted = False         # counted by Scheduler admission control
+        # Do not route exceptions to Scheduler
+        self.emitUnhandled = False    # emits done with unhandled exception as Return.value
+
+
+    # Do not pass exceptions to scheduler.
+    #
+    # Useful with WaitTask of WaitFirstTask calls.
+    def setEmitUnhandled( self, val = True ):
+        self.emitUnhandled = val
+
+
+    # Task of the frame
+    def root( self ):
+        return self
+
+
+    def val( self ):
+        if self.state == Task.DONE:
+            return self.result.value
+        if self.state in ( Task.EXCEPTION, Task.CANCELLED ):
+            return self.exception.orig
+        else:
+            assert False, "Can't get result. State: %d" % self.state
+
+
+    # Stop the task, coroutines finally blocks run now.
+    # Task waiters get TaskCancelled exception.
+    # Returns False, if the task is already over.
+    def cancel( self ):
+        if self.state not in ( Task.NEW, Task.RUNNING ):
+            return False
+
+        self.scheduler.cancelTask( self )
+        return True
+
+
+    def completed( self ):
+        self.state = Task.DONE
+        self.done.emit( self.result )
+
+
+    def unhandled( self ):
+        self.state = Task.EXCEPTION
+        if self.emitUnhandled:
+            self.done.emit( Return(self.exception) )
+            return STEP_DONE
+        else:
+            raise self.exception
+
+
+
+# Lightweight branch of Parallel, runs in the task group.
+# Results and exceptions go to Parallel.
+class Branch( Frame ):
+    branch = True
+
+    def __init__( self, parallel, index, coroutine, parent ):
+        self.initFrame( coroutine )
+        self.parallel = parallel
+        self.index = index
+        self.task = parent.root()
+        self.scheduler = parent.scheduler
+        self.group = parent.group
+        self.state = Frame.RUNNING
+
+
+    def root( self ):
+        return self.task
+
+
+    def completed( self ):
+        self.state = Frame.DONE
+        self.parallel.branchDone( self )
+
+
+    def unhandled( self ):
+        self.state = Frame.EXCEPTION
+        self.parallel.branchFailed( self )
+        return STEP_DONE
+
+
+    def __repr__( self ):
+        return 'Branch( %d of %s )' % (self.index, self.task)
+
+
+
+# Branch coroutine for other yieldables
+def yieldOne( value ):
+    result = yield value
+    yield Return( result )
+
+
+
+# Runs subcoroutines as branches of the task,
+# returns ordered results list. The first exception
+# cancels the other branches and is raised in the task.
+# Other yieldables (AsynchronousCall, Future, list) are branches too.
+#
+# Usage:
+#   a, b, c = yield [ sub1(), sub2(), sub3() ]
+#   a, b, c = yield Parallel( sub1(), sub2(), sub3() )
+class Parallel( object ):
+    def __init__( self, *coroutines ):
+        self.coroutines = [ isinstance(c, GeneratorType) and c or yieldOne(c) for c in coroutines ]
+        self.frame = None       # waiting Task or Branch
+        self.branches = []
+        self.results = None
+        self.running = 0
+
+
+    # Returns False, when the frame is parked
+    def start( self, frame ):
+        if not self.coroutines:
+            frame.sendval = []
+            return True
+
+        self.frame = frame
+        self.results = [ None ] * len( self.coroutines )
+        self.branches = [ Branch(self, i, c, frame) for i, c in enumerate(self.coroutines) ]
+        self.coroutines = None
+        self.running = len( self.branches )
+
+        scheduler = frame.scheduler
+        if scheduler.tracer is not None:
+            for b in self.branches:
+                scheduler.tracer.spawn( b, frame )
+        scheduler.scheduleMany( self.branches )
+        return False
+
+
+    def branchDone( self, branch ):
+        self.tracerDone( branch )
+        self.results[ branch.index ] = branch.result.value
+        self.running -= 1
+        if not self.running:
+            self.frame.sendval = self.results
+            self.frame.scheduler.schedule( self.frame )
+
+
+    def branchFailed( self, branch ):
+        self.tracerDone( branch )
+        self.running -= 1
+        self.cancel()
+        self.frame.exception = branch.exception
+        self.frame.scheduler.schedule( self.frame )
+
+
+    def tracerDone( self, branch ):
+        if branch.scheduler.tracer is not None:
+            branch.scheduler.tracer.done( branch )
+
+
+    # Frame is cancelled or the first branch failed
+    def cancel( self ):
+        for b in self.branches:
+            if b.state == Frame.RUNNING:
+                b.scheduler.cancelFrame( b )
+                self.tracerDone( b )
+        self.running = 0
+
+
+    def __repr__( self ):
+        return 'Parallel( %d branches, %d running )' % (len(self.branches), self.running)
+
+
+
+# Task.run dispatch: yielded value type -> handler( frame, value ).
+# Handler returns STEP_* status to go back to the scheduler,
+# None to continue the frame. (yield) and Checkpoint are traps of Task.run.
+yieldHandlers = {}
+
+
+def registerYieldable( cls, handler ):
+    yieldHandlers[ cls ] = handler
+
+
+
+# Subclasses use the base class handler, cached
+def findYieldHandler( frame ):
+    cls = type( frame.result )
+    for base in getattr( cls, '__mro__', () )[ 1: ]:
+        handler = yieldHandlers.get( base )
+        if handler is not None:
+            yieldHandlers[ cls ] = handler
+            return handler
+
+    # Unknown result type!?
+    raise TypeError( '%s\n\nWrong type %s yielded.' % \
+                     (frame.formatBacktrace(), cls) )
+
+
+
+# yield AsynchronousCall(..), handled by scheduler
+def yieldCall( frame, value ):
+    return STEP_CALL
+
+
+
+# value = yield future
+def yieldFuture( frame, value ):
+    if not value.resolve( frame ):
+        return STEP_WAIT
+
+
+
+# yield subcoroutine(..)
+def yieldGenerator( frame, value ):
+    # save current coroutine in stack
+    frame.stack.append( frame.coroutine )
+    frame.coroutine = value
+    frame.sendval = None
+
+
+
+# yield Return(..)
+def yieldReturn( frame, value ):
+    if frame.finish():
+        return STEP_DONE
+
+
+
+# results = yield [ subcoroutine(..), .. ] or Parallel(..)
+def yieldParallel( frame, value ):
+    if isinstance( value, list ):
+        value = frame.result = Parallel( *value )
+
+    if not value.start( frame ):
+        return STEP_WAIT
+
+
+
+registerYieldable( AsynchronousCall, yieldCall )
+registerYieldable( Future, yieldFuture )
+registerYieldable( GeneratorType, yieldGenerator )
+registerYieldable( Return, yieldReturn )
+registerYieldable( Parallel, yieldParallel )
+registerYieldable( list, yieldParallel )
+
+
+
+# Tasks sharing one cpu share, see Scheduler.newTask( .., group = name ).
+# Scheduler runs the ready group with the least vtime.
+class TaskGroup( object ):
+    def __init__( self, name, weight = 1.0 ):
+        assert weight > 0
+
+        self.name = name
+        self.weight = weight
+        self.ready = deque()
+        self.vtime = 0.0     # cpuTime / weight, while group was busy
+
+        # usage counters
+        self.cpuTime = 0.0   # seconds spent in Task.run
+        self.steps = 0
+        self.tasks = 0       # live tasks
+        self.spawned = 0
+
+
+    def usage( self ):
+        return { 'weight': self.weight,
+                 'cpuTime': self.cpuTime,
+                 'steps': self.steps,
+                 'tasks': self.tasks,
+                 'spawned': self.spawned,
+                 'ready': len(self.ready) }
+
+
+    def __repr__( self ):
+        return 'TaskGroup( %s, weight %g, %d tasks, %.3fs cpu )' % \
+               (self.name, self.weight, self.tasks, self.cpuTime)
+
+
+
+# Scheduler.every() job.
+# Ticks are absolute: start + n * interval,
+# every run is delayed by random 0..jitterMs after its tick.
+class PeriodicJob( object ):
+    def __init__( self, scheduler, intervalMs, factory, missed, jitterMs, group ):
+        assert intervalMs > 0
+
+        self.scheduler = scheduler
+        self.interval = intervalMs / 1000.0
+        self.jitter = jitterMs / 1000.0
+        self.factory = factory
+        self.missed = missed
+        self.group = group
+        self.tick = monotonic() + self.interval     # next tick
+        self.deadline = self.jittered( self.tick )  # next run
+        self.task = None        # last started task
+        self.running = False    # task started and its done not emitted yet
+        self.cancelled = False
+        self.owed = 0           # catch up runs, waiting for the running task
+
+        # counters
+        self.runs = 0
+        self.skipped = 0        # missed ticks not run
+        self.overlapped = 0     # ticks, while the previous task was running
+
+
+    # random delay spreads jobs with the same interval
+    def jittered( self, tick ):
+        if not self.jitter:
+            return tick
+        return tick + random.uniform( 0, self.jitter )
+
+
+    # Deadline passed, returns the next one
+    def fire( self, now ):
+        if self.missed == Scheduler.MISSED_CATCHUP:
+            # every tick runs, missed ones one after another
+            self.tick += self.interval
+            self.deadline = self.jittered( self.tick )
+            self.start()
+            return self.deadline
+
+        # whole periods we are late
+        late = int( (now - self.deadline) / self.interval )
+        self.tick += (late + 1) * self.interval
+        self.deadline = self.jittered( self.tick )
+        if late and self.missed == Scheduler.MISSED_SKIP:
+            # wait for the next tick on time
+            self.skipped += late + 1
+            return self.deadline
+
+        # one run for all missed ticks
+        self.skipped += late
+        self.start()
+        return self.deadline
+
+
+    def start( self ):
+        # overlap guard, unhandled exception ends the task without done
+        if self.running and self.task.state in ( Task.NEW, Task.RUNNING ):
+            self.overlapped += 1
+            if self.missed == Scheduler.MISSED_CATCHUP:
+                self.owed += 1
+            return
+
+        try:
+            self.task = self.scheduler.newTask( self.factory(), group = self.group )
+        except AdmissionRejected:
+            self.skipped += 1
+            return
+
+        self.running = True
+        self.runs += 1
+        self.task.done.connect( self.taskDone )
+
+
+    def taskDone( self, ret ):
+        self.running = False
+        if self.owed and not self.cancelled:
+            self.owed -= 1
+            self.start()
+
+
+    def cancel( self ):
+        if self.cancelled:
+            return
+
+        self.cancelled = True
+        self.owed = 0
+        self.scheduler.cancelPeriodic( self )
+
+
+    def __repr__( self ):
+        return 'PeriodicJob( %s every %g ms, %d runs, %d skipped, %d overlapped )' % \
+               (getattr(self.factory, '__name__', self.factory), self.interval * 1000,
+                self.runs, self.skipped, self.overlapped)
+
+
+
+class TaskCancelled( Exception ):
+    pass
+
+
+
+class AdmissionRejected( Exception ):
+    """ Scheduler.newTask over the admission limit """
+    def __init__( self, running, queued ):
+        Exception.__init__( self, 'Task rejected: %d running, %d queued.' % (running, queued) )
+
+
+
+class AdmissionDropped( Exception ):
+    """ Queued task dropped by ADMIT_DROP_OLDEST policy """
+
 
 
 class Scheduler( QObject ):
     longIteration = pyqtSignal( datetime.timedelta, Task )
     done = pyqtSignal()
 
+    # Admission control: queued tasks count
+    admissionQueueChanged = pyqtSignal( int )
+    # Admission control: total rejected newTask calls
+    admissionRejected = pyqtSignal( int )
+    # Admission control: queued task dropped, not started
+    admissionDropped = pyqtSignal( Task )
+
+    # Admission policies, see setAdmissionLimit()
+    ADMIT_QUEUE = 0         # wait in the queue, reject when queue is full
+    ADMIT_REJECT = 1        # raise AdmissionRejected
+    ADMIT_DROP_OLDEST = 2   # drop the oldest queued task, when queue is full
+
+    # Missed periodic ticks policies, see every()
+    MISSED_SKIP = 0         # do not run late ticks, wait for the next one
+    MISSED_COALESCE = 1     # run once for all missed ticks
+    MISSED_CATCHUP = 2      # run every missed tick, one after another
+
     def __init__( self, parent = None ):
         QObject.__init__( self, parent )
 
         self.task = None
         self.tasks = 0
-        self.ready = deque()
-        self.timerId = None
+        self.readyCount = 0
+        self.registry = {}          # tid -> live Task
+
+        # admission control
+        self.maxRunning = None      # unlimited
+        self.admissionPolicy = Scheduler.ADMIT_QUEUE
+        self.maxQueued = None       # unlimited
+        self.running = 0            # admitted tasks
+        self.admission = deque()    # queued NEW tasks, oldest on the right
+        self.rejectedCount = 0
+        self.droppedCount = 0
+
+        # (start time, task) of the running step, read by StallWatchdog
+        self.step = None
+        self.threadId = threading.current_thread().ident
+
+        # fair share between task groups
+        self.defaultGroup = TaskGroup( None )
+        self.groups = { None: self.defaultGroup }
+        self.activeGroups = []      # groups with ready tasks
+        self.vclock = 0.0           # vtime of the last running group
         self.printCoException = True
+        self.exceptionSink = None   # ExceptionSink, created on the first exception
+        self.raiseCoException = True    # raise reported CoExceptions in the main event loop too
+        self.checkpoints = 0
+        self.sliceDeadline = 0
+        self.timeSlice = TASK_TIME_SLICE.total_seconds()
+        self.tickRequested = 0
+
+        # Ticks are posted events: qt delivers events posted while
+        # delivering in the next loop pass, so the other events are not starved.
+        # useTimer = True - old zero interval timer ticks.
+        self.useTimer = False
+        self.tickPending = False
+        self.timerId = None
+
+        # periodic jobs: heap of (deadline, seq, PeriodicJob) on one timer
+        self.periodic = []
+        self.periodicSeq = itertools.count()
+        self.periodicTimerId = None
+        self.periodicDeadline = None
+
+        # always on health metrics
+        self.metrics = SchedulerMetrics()
+        self.metrics.addGauge( 'tasks', 'Live tasks.', lambda: self.tasks )
+        self.metrics.addGauge( 'ready_tasks', 'Tasks in the ready queue.', lambda: self.readyCount )
+        self.metrics.addGauge( 'admission_queued_tasks', 'Tasks waiting for admission.', lambda: len(self.admission) )
+        self.metrics.addGauge( 'admission_rejected_total', 'Rejected newTask calls.', lambda: self.rejectedCount )
+        self.metrics.addGauge( 'admission_dropped_total', 'Dropped queued tasks.', lambda: self.droppedCount )
+
+        # (func, args) from other threads
+        self.external = deque()
+        self.externalLock = threading.Lock()
+        self.externalPosted = False
+        self.externalDrains = 0
+
+        # tracer.TraceRecorder, see TraceRecorder.attach()
+        self.tracer = None
+        # memprofile.MemoryProfiler, see MemoryProfiler.start()
+        self.profiler = None
 
 
     # Schedule coroutine as Task
-    def newTask( self, coroutine, parent = None ):
+    #
+    # Tasks of the same group share cpu time by group weight,
+    # see setGroupWeight().
+    #
+    # Over admission limit raises AdmissionRejected or returns
+    # NEW task, which starts later, see setAdmissionLimit().
+    def newTask( self, coroutine, parent = None, group = None ):
         if parent is None:
             parent = self
 
+        queue = False
+        if self.maxRunning is not None and self.running >= self.maxRunning:
+            queue = self.checkAdmission()
+
         t = Task( parent, coroutine )  
-        t.destroyed.connect( self.taskDestroyed )
+        t.scheduler = self
+        t.group = self.getGroup( group )
+        t.group.tasks += 1
+        t.group.spawned += 1
+        t.destroyed.connect( partial(self.taskDestroyed, t.tid) )
+        self.registry[ t.tid ] = t
         self.tasks += 1
+        if self.tracer is not None:
+            self.tracer.spawn( t, self.task )
+
+        if queue:
+            self.admission.appendleft( t )
+            self.admissionQueueChanged.emit( len(self.admission) )
+        else:
+            self.start( t )
+        return t
+
 
+    # Start factory() coroutine as task every intervalMs.
+    #
+    # Ticks are not started, while the previous task is running.
+    # jitterMs - random delay of every run, spreads jobs with the same interval.
+    # missed - MISSED_* policy for ticks, the loop was too busy to run.
+    #
+    # Usage:
+    #   job = scheduler.every( 1000, lambda: coPoll(url) )
+    #   ...
+    #   job.cancel()
+    def every( self, intervalMs, factory, missed = MISSED_SKIP, jitterMs = 0, group = None ):
+        job = PeriodicJob( self, intervalMs, factory, missed, jitterMs, group )
+        heapq.heappush( self.periodic, (job.deadline, next(self.periodicSeq), job) )
+        self.armPeriodic()
+        return job
+
+
+    # see PeriodicJob.cancel()
+    def cancelPeriodic( self, job ):
+        # firing job is out of the heap, firePeriodic() does not push it back
+        self.periodic = [ e for e in self.periodic if e[ 2 ] is not job ]
+        heapq.heapify( self.periodic )
+        self.armPeriodic()
+
+
+    # One timer for the nearest deadline
+    def armPeriodic( self ):
+        deadline = self.periodic and self.periodic[ 0 ][ 0 ] or None
+        if deadline == self.periodicDeadline:
+            return
+
+        if self.periodicTimerId is not None:
+            self.killTimer( self.periodicTimerId )
+            self.periodicTimerId = None
+
+        self.periodicDeadline = deadline
+        if deadline is not None:
+            ms = max( 0, int((deadline - monotonic()) * 1000 + 0.999) )
+            self.periodicTimerId = self.startTimer( ms )
+
+
+    def firePeriodic( self ):
+        self.killTimer( self.periodicTimerId )
+        self.periodicTimerId = None
+        self.periodicDeadline = None
+
+        now = monotonic()
+        while self.periodic and self.periodic[ 0 ][ 0 ] <= now:
+            deadline, seq, job = heapq.heappop( self.periodic )
+            deadline = job.fire( now )
+            # cancelled by factory()
+            if not job.cancelled:
+                heapq.heappush( self.periodic, (max(deadline, now + 0.000001), seq, job) )
+
+        self.armPeriodic()
+
+
+    def start( self, t ):
         t.state = Task.RUNNING
+        t.admitted = True
+        self.running += 1
         self.schedule( t )
-        return t
+
+
+    # Limit concurrently running tasks.
+    #
+    # policy:
+    #   ADMIT_QUEUE - excess tasks wait, up to maxQueued (None - unlimited)
+    #   ADMIT_REJECT - newTask raises AdmissionRejected
+    #   ADMIT_DROP_OLDEST - the oldest of maxQueued waiting tasks is dropped
+    # maxRunning = None disables admission control.
+    def setAdmissionLimit( self, maxRunning, policy = ADMIT_QUEUE, maxQueued = None ):
+        assert policy != Scheduler.ADMIT_DROP_OLDEST or maxQueued > 0
+
+        self.maxRunning = maxRunning
+        self.admissionPolicy = policy
+        self.maxQueued = maxQueued
+        self.admitQueued()
+
+
+    # No free running slot: returns True to queue the new task,
+    # raises AdmissionRejected
+    def checkAdmission( self ):
+        policy = self.admissionPolicy
+        full = self.maxQueued is not None and len( self.admission ) >= self.maxQueued
+
+        if policy == Scheduler.ADMIT_REJECT or (policy == Scheduler.ADMIT_QUEUE and full):
+            self.rejectedCount += 1
+            self.admissionRejected.emit( self.rejectedCount )
+            raise AdmissionRejected( self.running, len(self.admission) )
+
+        if full:
+            self.dropTask( self.admission.pop() )
+
+        return True
+
+
+    # Finish queued task without running it
+    def dropTask( self, t ):
+        self.droppedCount += 1
+        t.state = Task.EXCEPTION
+        t.exception = CoException( AdmissionDropped('%s dropped by admission control.' % t) )
+        if t.emitUnhandled:
+            t.done.emit( Return(t.exception) )
+
+        self.reap( t )
+        self.admissionDropped.emit( t )
+        self.admissionQueueChanged.emit( len(self.admission) )
+
+
+    # see Task.cancel()
+    def cancelTask( self, t ):
+        assert self.task is None or self.task.root() is not t, \
+               "Task can't cancel itself, raise or return instead"
+
+        if t.state == Task.NEW:
+            self.admission.remove( t )
+            self.admissionQueueChanged.emit( len(self.admission) )
+
+        self.cancelFrame( t )
+        t.done.emit( Return(t.exception) )
+        self.reap( t )
+
+
+    # Task or branch: unpark, run finally blocks
+    def cancelFrame( self, t ):
+        if t.waitingOn is not None:
+            # parked: release the call
+            if isinstance( t.waitingOn, Future ):
+                t.waitingOn.discard( t )
+            else:
+                t.waitingOn.cancel()
+            t.waitingOn = None
+        elif t.state == Task.RUNNING:
+            # ready
+            g = t.group
+            g.ready.remove( t )
+            self.readyCount -= 1
+            if not g.ready:
+                self.activeGroups.remove( g )
+
+        t.state = Task.CANCELLED
+        t.exception = CoException( TaskCancelled('%s cancelled.' % t.root()) )
+
+        # run finally blocks, from the top subcoroutine
+        for c in [ t.coroutine ] + list( reversed(t.stack) ):
+            try:
+                c.close()
+            except Exception:
+                # yield in finally, nothing to do
+                pass
+        t.stack.clear()
+
+
+    # Start queued tasks, while there are free running slots
+    def admitQueued( self ):
+        if not self.admission:
+            return
+
+        while self.admission and (self.maxRunning is None or self.running < self.maxRunning):
+            self.start( self.admission.pop() )
+
+        self.admissionQueueChanged.emit( len(self.admission) )
+
+
+    # Task is done, forget it
+    def reap( self, t ):
+        if self.tracer is not None:
+            self.tracer.done( t )
+
+        t.deleteLater()
+        t.group.tasks -= 1
+        self.registry.pop( t.tid, None )
+
+        if t.admitted:
+            t.admitted = False
+            self.running -= 1
+            self.admitQueued()
+
+
+    def getGroup( self, name ):
+        group = self.groups.get( name )
+        if group is None:
+            group = self.groups[ name ] = TaskGroup( name )
+        return group
+
+
+    # Group gets cpu time proportionally to weight,
+    # when other groups are busy too.
+    def setGroupWeight( self, name, weight ):
+        assert weight > 0
+        self.getGroup( name ).weight = weight
+
+
+    # name -> usage counters dict
+    def groupUsage( self ):
+        return dict( (name, g.usage()) for name, g in self.groups.iteritems() )
 
 
     def schedule( self, t ):
-        self.ready.appendleft( t )
+        # late wakeup of cancelled task?
+        if t.state != Task.RUNNING:
+            return
 
-        if self.timerId is None:
+        self.enqueue( t, monotonic() )
+
+        if not self.tickPending:
+            self.requestTick( t.scheduledAt )
+
+
+    # Bulk schedule: one clock read, one tick request
+    def scheduleMany( self, tasks ):
+        now = monotonic()
+        for t in tasks:
+            if t.state != Task.RUNNING:
+                continue
+            if self.tracer is not None:
+                self.tracer.wakeup( t, self.task )
+            self.enqueue( t, now )
+
+        if tasks and not self.tickPending:
+            self.requestTick( now )
+
+
+    def requestTick( self, now ):
+        self.tickPending = True
+        self.tickRequested = now
+        if self.useTimer:
             self.timerId = self.startTimer( 0 )
+        else:
+            QCoreApplication.postEvent( self, QEvent(SCHEDULE_EVENT) )
+
+
+    # do not loop, if all tasks done
+    def tickDone( self ):
+        if not self.readyCount:
+            self.tickPending = False
+            if self.timerId is not None:
+                self.killTimer( self.timerId )
+                self.timerId = None
+            return
+
+        self.tickRequested = monotonic()
+        if self.timerId is None:
+            # zero interval timer fires again by itself
+            QCoreApplication.postEvent( self, QEvent(SCHEDULE_EVENT) )
+
+
+    # Continue task with value or raise Exception in it
+    def resume( self, task, value = None ):
+        if isinstance( value, Exception ):
+            if not isinstance( value, CoException ):
+                value = CoException( value )
+            task.exception = value
+        else:
+            task.sendval = value
+
+        if self.tracer is not None:
+            self.tracer.wakeup( task, self.task )
 
+        self.schedule( task )
+
+
+    # Thread safe Scheduler.resume
+    #
+    # Usage (from worker thread):
+    #   scheduler.scheduleThreadsafe( task, result )
+    def scheduleThreadsafe( self, task, value = None ):
+        self.callThreadsafe( self.resume, task, value )
+
+
+    # Thread safe: func( *args ) will be called from the scheduler thread.
+    # Burst of calls wakes up qt loop once and drained in bulk.
+    def callThreadsafe( self, func, *args ):
+        with self.externalLock:
+            self.external.append( (func, args) )
+            if self.externalPosted:
+                return
+            self.externalPosted = True
+
+        QCoreApplication.postEvent( self, QEvent(EXTERNAL_EVENT) )
+
+
+    def customEvent( self, e ):
+        if e.type() == SCHEDULE_EVENT:
+            self.tick()
+        elif e.type() == EXTERNAL_EVENT:
+            self.drainExternal()
+
+
+    def timerEvent( self, e ):
+        if e.timerId() == self.timerId:
+            self.tick()
+        elif e.timerId() == self.periodicTimerId:
+            self.firePeriodic()
+
+
+    def drainExternal( self ):
+        with self.externalLock:
+            calls = self.external
+            self.external = deque()
+            self.externalPosted = False
+
+        self.externalDrains += 1
+        for func, args in calls:
+            func( *args )
+
+
+    def taskDestroyed( self, tid, task = None ):
+        t = self.registry.pop( tid, None )
+        if t is not None:
+            # destroyed by parent, not finished
+            if t.admitted:
+                t.admitted = False
+                self.running -= 1
+                self.admitQueued()
+            elif t in self.admission:
+                self.admission.remove( t )
+                self.admissionQueueChanged.emit( len(self.admission) )
 
-    def taskDestroyed( self, task ):
         self.tasks -= 1
 
         if not self.tasks:
@@ -419,65 +1593,217 @@ class Scheduler( QObject ):
         return False
 
 
-    # Show coroutines stack
-    def formatException( self ):
-        assert isinstance( self.task, Task )
-        assert isinstance( self.task.exception, CoException )
+    def enqueue( self, t, now ):
+        if self.tracer is not None:
+            self.tracer.schedule( t, now )
+
+        t.scheduledAt = now
+        t.waitingOn = None
+        g = t.group
+        if not g.ready:
+            # idle group does not save up its share
+            if g.vtime < self.vclock:
+                g.vtime = self.vclock
+            self.activeGroups.append( g )
+
+        g.ready.appendleft( t )
+        self.readyCount += 1
+
+
+    # Next task of the group with the least vtime
+    def nextTask( self ):
+        groups = self.activeGroups
+        g = groups[ 0 ]
+        if len( groups ) > 1:
+            for other in groups:
+                if other.vtime < g.vtime:
+                    g = other
+
+        self.vclock = g.vtime
+        self.readyCount -= 1
+        t = g.ready.pop()
+        if not g.ready:
+            groups.remove( g )
+        return t
+
+
+    # Checkpoint trap: go back to the qt loop?
+    def sliceExpired( self ):
+        self.checkpoints += 1
+        if self.checkpoints % CHECKPOINT_CLOCK_INTERVAL:
+            return False
 
-        return '\nUNHANDLED COROUTINE EXCEPTION BACKTRACE (self.printCoException is True)!\n%s' % self.task.exception
+        return monotonic() >= self.sliceDeadline or QCoreApplication.hasPendingEvents()
+
+
+    # Live tasks introspection.
+    #
+    # waitType - AsynchronousCall class or class name,
+    # returns only tasks parked on it.
+    def dump( self, waitType = None ):
+        now = monotonic()
+        res = []
+        for t in self.registry.itervalues():
+            call = t.waitingOn
+            if waitType is not None:
+                if isinstance( waitType, basestring ):
+                    if call is None or type( call ).__name__ != waitType:
+                        continue
+                elif not isinstance( call, waitType ):
+                    continue
+
+            if t is self.task:
+                state = 'running'
+            elif t.state == Task.NEW:
+                state = 'queued'
+            elif call is not None:
+                state = 'waiting'
+            else:
+                state = 'ready'
+
+            res.append( { 'tid': t.tid,
+                          'state': state,
+                          'group': t.group.name,
+                          'waitingOn': call is not None and type( call ).__name__ or None,
+                          'waitTime': call is not None and now - t.waitingSince or 0,
+                          'age': now - t.created,
+                          'stack': t.coroutineStack() } )
+        return res
+
+
+    # Parked tasks count by AsynchronousCall class name
+    def waitSummary( self ):
+        res = {}
+        for t in self.registry.itervalues():
+            if t.waitingOn is not None:
+                name = type( t.waitingOn ).__name__
+                res[ name ] = res.get( name, 0 ) + 1
+        return res
+
+
+    def formatDump( self, waitType = None ):
+        lines = []
+        for e in sorted( self.dump(waitType), key = lambda e: -e['waitTime'] ):
+            lines.append( 'Task %(tid)d %(state)s, group %(group)s, age %(age).3fs, '
+                          'waiting %(waitingOn)s %(waitTime).3fs' % e )
+            lines.extend( '  File "%s", line %d, in %s' % f for f in e[ 'stack' ] )
+        return '\n'.join( lines )
 
 
     # The scheduler loop!
-    def timerEvent( self, e ):
+    def tick( self ):
         # Do not iterate too much.. 
         self.startIterationTime = datetime.datetime.now()
         self.lastIterationTime = self.startIterationTime
+        now = monotonic()
+        self.metrics.lag.observe( now - self.tickRequested )
+        self.metrics.readyDepth.observe( self.readyCount )
+        steps = 0
         timeout = False
-        for i in xrange( MAX_SCHEDULER_ITERATIONS ):
-            if timeout or not self.ready:
-                break
-
-            self.task = self.ready.pop()
-            try:
-                result = self.task.run()
-                
-                if isinstance( result, AsynchronousCall ):
-                    result.setContext( self.task, self )
-                    result.handle()
-
-                    # AsynchronousCall will resume execution later
-                    continue
+        try:
+            for i in xrange( MAX_SCHEDULER_ITERATIONS ):
+                if timeout or not self.readyCount:
+                    break
+
+                self.task = self.nextTask()
+                steps += 1
+                now = monotonic()
+                self.metrics.waitToRun.observe( now - self.task.scheduledAt )
+                self.sliceDeadline = now + self.timeSlice
+                self.step = (now, self.task)
+                if self.tracer is not None:
+                    self.tracer.resume( self.task, now )
+                if self.profiler is not None:
+                    self.profiler.stepStarted( self.task )
+
+                try:
+                    status = self.task.run()
+                    while status == STEP_CALL:
+                        call = self.task.result
+
+                        # wakeup clears it
+                        self.task.waitingOn = call
+                        self.task.waitingSince = now
+                        if not call.dispatch( self.task, self ):
+                            break
+
+                        self.task.waitingOn = None
+
+                        # completed inside handle(), resume in the same step
+                        if monotonic() >= self.sliceDeadline:
+                            status = STEP_YIELD
+                            break
+
+                        status = self.task.run()
+
+                    if status == STEP_CALL:
+                        if self.tracer is not None:
+                            self.tracer.suspend( self.task, call )
+
+                        # AsynchronousCall will resume execution later
+                        continue
+
+                    if status == STEP_DONE:
+                        # branches join Parallel themselves
+                        if not self.task.branch:
+                            self.reap( self.task )
+                        continue
+
+                    if status == STEP_WAIT:
+                        # Future.complete() will resume execution later
+                        self.task.waitingOn = self.task.result
+                        self.task.waitingSince = now
+                        if self.tracer is not None:
+                            self.tracer.suspend( self.task, self.task.result )
+                        continue
                      
-            except Exception, e:
-                self.task.deleteLater()
-
-                if isinstance( e, StopIteration ):
-                    continue
-
-                if isinstance( e, CoException ) and self.printCoException:
-                    sys.stdout.write( self.formatException() )
+                except Exception, e:
+                    # AsynchronousCall of a branch failed, Parallel raises it in the task
+                    if self.task.branch:
+                        self.task.exception = CoException( e )
+                        self.task.exception.updateStack()
+                        self.task.unhandled()
+                        continue
+
+                    self.reap( self.task )
+
+                    # do not block the loop on terminal or pipe
+                    if isinstance( e, CoException ) and self.printCoException:
+                        if self.exceptionSink is None:
+                            self.exceptionSink = ExceptionSink()
+                        self.exceptionSink.report( self.task, e )
+
+                        # reported, go on with other tasks
+                        if not self.raiseCoException:
+                            continue
+
+                    # forward exception to the main event loop
+                    raise
 
-                # this is unknown exception!
-                # stop iterating timer, if all tasks done
-                if not self.ready:
-                    self.killTimer( self.timerId )
-                    self.timerId = None
+                finally:
+                    self.step = None
+                    if self.profiler is not None:
+                        self.profiler.stepDone( self.task )
 
-                # forward exception to the main event loop
-                raise
+                    # fair share accounting
+                    g = self.task.group
+                    end = monotonic()
+                    runtime = end - now
+                    g.cpuTime += runtime
+                    g.vtime += runtime / g.weight
+                    g.steps += 1
 
-            finally:
-                timeout = self.checkRuntime( self.task )
+                    timeout = self.checkRuntime( self.task.root() )
 
-            # continue this task later
-            self.ready.appendleft( self.task )
+                # continue this task later
+                self.enqueue( self.task, end )
 
-        # do not lopp, if all tasks done
-        if not self.ready:
-            self.killTimer( self.timerId )
-            self.timerId = None
+            self.metrics.stepsPerTick.observe( steps )
 
-        self.task = None
+        finally:
+            # stop ticks, if all tasks done
+            self.tickDone()
+            self.task = None
 
 
 
@@ -509,11 +1835,11 @@ def coWaitTasks( tasks, maxTimeoutMs, breakFunc = lambda tasks, t: False ):
 
 # paramsList - list( *argv1, *argv2, ... )
 # will start coTask( *argv1 ), coTask( *argv2 )... and returns tasks set
-def coMassiveStart( coTask, tasksParams, serialTimeoutMs = 0, emitUnhandled = True ):
+def coMassiveStart( coTask, tasksParams, serialTimeoutMs = 0, emitUnhandled = True, group = None ):
     scheduler = QCoreApplication.instance().scheduler
     tasks = set()
     for argv in tasksParams:
-        t = scheduler.newTask( coTask(*argv) )
+        t = scheduler.newTask( coTask(*argv), group = group )
         if emitUnhandled:
             t.setEmitUnhandled()
 
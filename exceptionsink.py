@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Non-blocking reporting of unhandled coroutine exceptions.
+#
+# GNU LGPL v. 2.1
+
+import sys
+import time
+import atexit
+import threading
+from collections import deque
+
+
+# Queued exception records at most, newer ones are dropped and counted
+SINK_MAX_QUEUED = 1000
+
+
+# Writer collects records that long, identical backtraces are written once
+SINK_BATCH_INTERVAL = 0.5
+
+
+SINK_HEADER = '\nUNHANDLED COROUTINE EXCEPTION BACKTRACE (self.printCoException is True)!\n'
+
+
+# Sinks with writer threads, written on exit
+liveSinks = set()
+
+
+
+def flushSinks():
+    for sink in list( liveSinks ):
+        sink.flush()
+
+
+
+atexit.register( flushSinks )
+
+
+
+# Scheduler reports unhandled CoExceptions here, see Scheduler.exceptionSink.
+# report() only queues the record, the writer thread formats
+# and writes batches, repeated backtraces once with counts.
+# Scheduler still raises them in the main event loop, where sys.excepthook
+# writes them synchronously, set Scheduler.raiseCoException = False
+# to keep the scheduler off terminal I/O.
+#
+# Any object with report( task, exception ) is a sink.
+#
+# Usage:
+#   scheduler.exceptionSink = ExceptionSink( open('errors.log', 'a') )
+#   scheduler.raiseCoException = False
+#   ...
+#   sink.close()
+class ExceptionSink( object ):
+    def __init__( self, stream = None, maxQueued = SINK_MAX_QUEUED, interval = SINK_BATCH_INTERVAL ):
+        self.stream = stream
+        self.maxQueued = maxQueued
+        self.interval = interval
+
+        self.records = deque()      # (time, task repr, CoException)
+        self.lock = threading.Condition()
+        self.writing = False        # writer holds a batch
+        self.closing = False        # writer exits, when queue is empty
+        self.flushing = False       # flush() waits, do not collect the batch
+        self.dropped = 0            # not queued, queue was full
+        self.droppedBatch = 0       # dropped since the last write
+        self.reported = 0
+        self.written = 0            # written blocks
+        self.thread = None
+
+
+    # Scheduler thread, never blocks on I/O
+    def report( self, task, exception ):
+        with self.lock:
+            self.reported += 1
+            if len( self.records ) >= self.maxQueued:
+                self.dropped += 1
+                self.droppedBatch += 1
+                return
+
+            self.records.append( (time.time(), repr(task), exception) )
+            if self.thread is None:
+                self.start()
+            if len( self.records ) == 1:
+                self.lock.notify()
+
+
+    def start( self ):
+        self.closing = False
+        self.thread = threading.Thread( target = self.work, name = 'ExceptionSink' )
+        self.thread.daemon = True
+        self.thread.start()
+        # write the rest on exit
+        liveSinks.add( self )
+
+
+    # Write queued records, stop the writer thread
+    def close( self, timeout = 5.0 ):
+        if self.thread is None:
+            return
+
+        self.flush( timeout )
+        with self.lock:
+            self.closing = True
+            self.lock.notify_all()
+        self.thread.join( timeout )
+        self.thread = None
+        liveSinks.discard( self )
+
+
+    # Wait, until queued records are written
+    def flush( self, timeout = 5.0 ):
+        deadline = time.time() + timeout
+        with self.lock:
+            self.flushing = True
+            try:
+                while (self.records or self.writing) and time.time() < deadline:
+                    self.lock.notify_all()
+                    self.lock.wait( 0.01 )
+            finally:
+                self.flushing = False
+
+
+    # writer thread
+    def work( self ):
+        while True:
+            with self.lock:
+                while not self.records:
+                    if self.closing:
+                        return
+                    self.lock.wait()
+                self.writing = True
+
+                # let the burst accumulate
+                deadline = time.time() + self.interval
+                while not self.flushing and time.time() < deadline:
+                    self.lock.wait( deadline - time.time() )
+
+                batch = self.records
+                self.records = deque()
+                dropped = self.droppedBatch
+                self.droppedBatch = 0
+
+            try:
+                self.write( batch, dropped )
+            finally:
+                with self.lock:
+                    self.writing = False
+                    self.lock.notify_all()
+
+
+    def write( self, batch, dropped ):
+        # formatted backtrace -> [ count, first time, first task ]
+        blocks = {}
+        order = []
+        for t, task, exception in batch:
+            text = str( exception )
+            block = blocks.get( text )
+            if block is None:
+                block = blocks[ text ] = [ 0, t, task ]
+                order.append( text )
+            block[ 0 ] += 1
+
+        out = []
+        for text in order:
+            count, t, task = blocks[ text ]
+            out.append( SINK_HEADER + text )
+            if count > 1:
+                out.append( '(repeated %d times, first in %s at %s)\n' %
+                            (count, task, time.strftime('%H:%M:%S', time.localtime(t))) )
+
+        if dropped:
+            out.append( '\n%d more coroutine exceptions dropped, sink queue is full.\n' % dropped )
+
+        stream = self.stream or sys.stdout
+        stream.write( ''.join(out) )
+        stream.flush()
+        self.written += len( order )
+
+
+    def __repr__( self ):
+        return 'ExceptionSink( %d reported, %d queued, %d dropped )' % \
+               (self.reported, len(self.records), self.dropped)
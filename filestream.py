@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Chunked file reading for coroutines.
+#
+# GNU LGPL v. 2.1
+
+import io
+import os
+import mmap
+import stat
+import Queue
+import threading
+from collections import deque
+from coroutines import AsynchronousCall, Checkpoint, Return
+
+
+# FileStream.read() chunk size
+FILE_CHUNK_SIZE = 1024 * 1024
+
+
+# Chunks read in the background, ahead of the current one
+FILE_PREFETCH_CHUNKS = 2
+
+
+
+# Zero copy slice of mmap
+try:
+    memoryview( mmap.mmap(-1, 1) )
+
+    def mmapSlice( mm, offset, size ):
+        return memoryview( mm )[ offset: offset + size ]
+
+except TypeError:
+    # python 2 mmap has old buffer interface only
+    def mmapSlice( mm, offset, size ):
+        return buffer( mm, offset, size )
+
+
+
+# Copy chunk into str
+def chunkBytes( chunk ):
+    if isinstance( chunk, memoryview ):
+        return chunk.tobytes()
+    return str( chunk )
+
+
+
+class ChunkRead( AsynchronousCall ):
+    # ready chunks complete inside handle()
+    inlineWakeup = True
+
+    def __init__( self, stream ):
+        AsynchronousCall.__init__( self )
+        self.stream = stream
+
+
+    def handle( self ):
+        # completes inline, when chunk is ready
+        self.stream.nextChunk( self )
+
+
+    def cancel( self ):
+        if self.stream.waiter is self:
+            self.stream.waiter = None
+
+
+
+# Reads file by chunks without blocking the qt loop.
+#
+# Regular files are memory mapped, chunks are zero copy
+# views and the worker thread pulls next chunks into page cache.
+# Otherwise (useMmap = False, empty or unmappable files, pipes, devices)
+# the worker thread fills pooled buffers, until it reads nothing.
+# Read error is raised by this and every later read().
+#
+# Chunk is valid until the next read().
+#
+# Usage:
+#   stream = FileStream( path )
+#   try:
+#       while True:
+#           chunk = yield stream.read()
+#           if not chunk:
+#               break
+#           ...
+#   finally:
+#       stream.close()
+class FileStream( object ):
+    def __init__( self, path, chunkSize = FILE_CHUNK_SIZE, useMmap = True, prefetch = FILE_PREFETCH_CHUNKS ):
+        self.path = path
+        self.chunkSize = chunkSize
+        self.prefetch = prefetch
+
+        self.file = io.open( path, 'rb', buffering = 0 )
+        st = os.fstat( self.file.fileno() )
+        self.size = st.st_size  # 0 for pipes and /proc files
+        self.offset = 0        # next chunk to return
+        self.nextOffset = 0    # next chunk to give the worker
+        self.tail = ''         # incomplete line for readLines()
+
+        self.mm = None
+        if useMmap and stat.S_ISREG( st.st_mode ) and self.size:
+            try:
+                self.mm = mmap.mmap( self.file.fileno(), 0, access = mmap.ACCESS_READ )
+            except (mmap.error, ValueError):
+                pass
+
+        # pooled buffers mode
+        self.pool = []
+        self.current = None     # buffer of the returned chunk
+        self.filled = deque()   # (buffer, size or Exception), file order
+        self.waiter = None      # ChunkRead
+        self.atEnd = False      # worker read nothing
+        self.error = None       # worker read Exception
+        if self.mm is None:
+            self.pool = [ bytearray(chunkSize) for i in xrange( prefetch + 1 ) ]
+
+        self.scheduler = None
+        self.jobs = None
+        self.worker = None
+        self.closed = False
+
+
+    # Subcoroutine, returns next chunk or '' at the end
+    def read( self ):
+        # let other tasks run between chunks
+        yield Checkpoint()
+        chunk = yield ChunkRead( self )
+        yield Return( chunk )
+
+
+    # Subcoroutine, returns complete lines (without '\n') of next chunks,
+    # [] at the end of file
+    def readLines( self ):
+        while True:
+            chunk = yield self.read()
+            if not chunk:
+                lines = self.tail and [ self.tail ] or []
+                self.tail = ''
+                yield Return( lines )
+
+            lines = (self.tail + chunkBytes( chunk )).split( '\n' )
+            self.tail = lines.pop()
+            if lines:
+                yield Return( lines )
+
+
+    # called by ChunkRead
+    def nextChunk( self, call ):
+        self.scheduler = call.scheduler
+
+        if self.mm is not None:
+            size = min( self.chunkSize, self.size - self.offset )
+            if size <= 0:
+                call.wakeup( '' )
+                return
+
+            chunk = mmapSlice( self.mm, self.offset, size )
+            self.offset += size
+            self.submit()
+            call.wakeup( chunk )
+            return
+
+        # previous chunk is not used anymore
+        if self.current is not None:
+            self.pool.append( self.current )
+            self.current = None
+
+        self.submit()
+        self.waiter = call
+        self.deliver()
+
+
+    # give the worker next chunks
+    def submit( self ):
+        if self.mm is not None:
+            offset = max( self.nextOffset, self.offset )
+            end = min( self.offset + self.prefetch * self.chunkSize, self.size )
+            while offset < end:
+                self.startJob( offset, None )
+                offset += self.chunkSize
+            self.nextOffset = offset
+            return
+
+        # size of special files is unknown, read until nothing is read
+        while self.pool and not self.atEnd and self.error is None:
+            self.startJob( self.nextOffset, self.pool.pop() )
+            self.nextOffset += self.chunkSize
+
+
+    def startJob( self, offset, buf ):
+        if self.worker is None:
+            self.jobs = Queue.Queue()
+            # own descriptor, main thread may close self.file
+            f = io.open( os.dup(self.file.fileno()), 'rb', buffering = 0 )
+            self.worker = threading.Thread( target = self.work, args = (self.jobs, f), name = 'FileStream' )
+            self.worker.daemon = True
+            self.worker.start()
+
+        self.jobs.put( (offset, buf) )
+
+
+    # worker thread
+    def work( self, jobs, f ):
+        scratch = None
+        try:
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+
+                offset, buf = job
+                if buf is not None:
+                    try:
+                        # jobs come in order, read sequentially:
+                        # pipes do not seek, special files read short
+                        size = f.readinto( buf )
+                    except Exception, e:
+                        size = e
+                    self.scheduler.callThreadsafe( self.chunkFilled, buf, size )
+                else:
+                    # mmap readahead, pull pages into the page cache
+                    if scratch is None:
+                        scratch = bytearray( self.chunkSize )
+                    f.seek( offset )
+                    f.readinto( scratch )
+        finally:
+            f.close()
+
+
+    def chunkFilled( self, buf, size ):
+        if self.closed:
+            return
+
+        # read after the end or the error
+        if self.atEnd or self.error is not None:
+            self.pool.append( buf )
+            return
+
+        self.filled.append( (buf, size) )
+        self.deliver()
+
+
+    def deliver( self ):
+        if self.waiter is None:
+            return
+
+        if self.error is None and not self.atEnd:
+            if not self.filled:
+                # in flight
+                return
+
+            buf, size = self.filled.popleft()
+            if isinstance( size, Exception ):
+                self.error = size
+            elif not size:
+                self.atEnd = True
+
+            if self.error is not None or self.atEnd:
+                # later reads get the same, buffers are not needed
+                self.pool.append( buf )
+                self.pool.extend( b for b, rest in self.filled )
+                self.filled.clear()
+            else:
+                self.current = buf
+                self.offset += size
+                waiter = self.waiter
+                self.waiter = None
+                waiter.wakeup( memoryview(buf)[ :size ] )
+                return
+
+        waiter = self.waiter
+        self.waiter = None
+        if self.error is not None:
+            waiter.wakeup( self.error )
+        else:
+            # end of file
+            waiter.wakeup( '' )
+
+
+    def close( self ):
+        self.closed = True
+        if self.jobs is not None:
+            self.jobs.put( None )
+            self.jobs = None
+
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+        self.file.close()
+
+
+    def __repr__( self ):
+        return 'FileStream( %s, %d of %d bytes )' % (self.path, self.offset, self.size)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Hedged requests: cut tail latency with late backup attempts.
+#
+# GNU LGPL v. 2.1
+
+from coroutines import WaitFirstTask, Return, Task, monotonic
+from metrics import Histogram, LATENCY_BUCKETS
+
+
+# Backup attempt starts, when no result that long.
+# Used until HEDGE_MIN_SAMPLES latencies observed, then the latency quantile.
+HEDGE_DELAY_MS = 100
+
+
+# Latencies to observe before adaptive delay
+HEDGE_MIN_SAMPLES = 20
+
+
+# Backup attempts per call at most
+HEDGE_MAX_ATTEMPTS = 2
+
+
+# Backup attempts / calls at most
+HEDGE_MAX_EXTRA_LOAD = 0.1
+
+
+
+# Runs factory( *args ) coroutine. If no result within the delay,
+# starts a duplicate, up to maxAttempts. Returns the first success,
+# cancels the rest. Raises the last exception, when all attempts failed.
+#
+# Delay is delayMs, or the observed quantile of call latency, when delayMs is None.
+# maxExtraLoad caps backup attempts as a share of calls.
+#
+# Usage:
+#   hedge = Hedge( scheduler, client.fetch )
+#   body = yield hedge.run( url )
+#   print hedge.stats()
+class Hedge( object ):
+    def __init__( self, scheduler, factory, delayMs = None, quantile = 0.95,
+                  maxAttempts = HEDGE_MAX_ATTEMPTS, maxExtraLoad = HEDGE_MAX_EXTRA_LOAD, group = None ):
+        assert maxAttempts >= 1
+
+        self.scheduler = scheduler
+        self.factory = factory
+        self.fixedDelayMs = delayMs
+        self.quantile = quantile
+        self.maxAttempts = maxAttempts
+        self.maxExtraLoad = maxExtraLoad
+        self.group = group
+
+        self.latency = Histogram( 'hedge_latency_seconds', 'Hedged call latency.', LATENCY_BUCKETS )
+        self.calls = 0
+        self.hedged = 0       # backup attempts started
+        self.hedgeWins = 0    # calls won by a backup attempt
+        self.failures = 0     # calls failed
+        self.cancelled = 0    # attempts cancelled
+
+
+    def delayMs( self ):
+        if self.fixedDelayMs is not None:
+            return self.fixedDelayMs
+
+        if self.latency.count < HEDGE_MIN_SAMPLES:
+            return HEDGE_DELAY_MS
+
+        return max( 1, int(self.latency.quantile( self.quantile ) * 1000) )
+
+
+    # extra load budget
+    def canHedge( self ):
+        return self.hedged < self.maxExtraLoad * self.calls
+
+
+    def spawn( self, args ):
+        t = self.scheduler.newTask( self.factory(*args), group = self.group )
+        # exceptions are results of attempts
+        t.setEmitUnhandled()
+        return t
+
+
+    # Subcoroutine, returns the first success
+    def run( self, *args ):
+        self.calls += 1
+        start = monotonic()
+        first = self.spawn( args )
+        tasks = [ first ]
+        error = None
+        try:
+            while tasks:
+                timeoutMs = 0
+                if len( tasks ) < self.maxAttempts and self.canHedge():
+                    timeoutMs = self.delayMs()
+
+                t = yield WaitFirstTask( tasks, timeoutMs )
+
+                # no result in time, start backup
+                if t is None:
+                    self.hedged += 1
+                    tasks.append( self.spawn(args) )
+                    continue
+
+                tasks.remove( t )
+                if t.state == Task.DONE:
+                    break
+
+                # failed attempt, others may succeed
+                error = t.exception
+            else:
+                self.failures += 1
+                raise error.orig
+
+        finally:
+            # losers, or all attempts, when our task is cancelled
+            for other in tasks:
+                if other.cancel():
+                    self.cancelled += 1
+
+        self.latency.observe( monotonic() - start )
+        if t is not first:
+            self.hedgeWins += 1
+
+        yield Return( t.result.value )
+
+
+    def hedgeRate( self ):
+        return self.calls and float( self.hedged ) / self.calls or 0.0
+
+
+    def winRate( self ):
+        return self.hedged and float( self.hedgeWins ) / self.hedged or 0.0
+
+
+    def stats( self ):
+        return { 'calls': self.calls,
+                 'hedged': self.hedged,
+                 'hedgeWins': self.hedgeWins,
+                 'failures': self.failures,
+                 'cancelled': self.cancelled,
+                 'hedgeRate': self.hedgeRate(),
+                 'winRate': self.winRate(),
+                 'delayMs': self.delayMs() }
+
+
+    def __repr__( self ):
+        return 'Hedge( %d calls, %.1f%% hedged, %.1f%% hedges won )' % \
+               (self.calls, self.hedgeRate() * 100, self.winRate() * 100)
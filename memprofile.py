@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Opt-in per coroutine memory attribution.
+# tracemalloc (python 3.4+ or python 2.7 patched for pytracemalloc):
+# traced allocations. Otherwise: memory held by coroutine frames.
+#
+# GNU LGPL v. 2.1
+
+import gc
+import os
+import sys
+from dis import findlinestarts
+from collections import deque
+from coroutines import monotonic, Parallel
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# Traceback depth of traced allocations: enough to reach coroutine frames
+# from the allocation point.
+MEMORY_TRACE_FRAMES = 25
+
+
+# Live bytes of frames outside coroutines
+OTHER = '<other>'
+
+
+# tracemalloc tracebacks are oldest frame first since python 3.7
+INNERMOST_LAST = sys.version_info >= ( 3, 7 )
+
+
+# Without tracemalloc: objects reachable through these from
+# coroutine frame locals are held by the coroutine
+CONTAINERS = ( list, tuple, dict, set, frozenset, deque )
+
+
+
+def codeKey( code ):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+
+# (bytes, objects) reachable from roots through CONTAINERS,
+# objects in seen are not counted again
+def heldSize( roots, seen ):
+    size = blocks = 0
+    stack = list( roots )
+    while stack:
+        o = stack.pop()
+        if id( o ) in seen:
+            continue
+
+        seen.add( id(o) )
+        size += sys.getsizeof( o )
+        blocks += 1
+        if isinstance( o, CONTAINERS ):
+            stack.extend( gc.get_referents(o) )
+
+    return size, blocks
+
+
+
+class CoroutineMemory( object ):
+    def __init__( self, key ):
+        self.key = key
+        self.steps = 0
+        self.allocated = 0      # traced memory growth during steps, bytes
+        self.freed = 0          # traced memory decrease during steps, bytes
+
+
+    def net( self ):
+        return self.allocated - self.freed
+
+
+    def __repr__( self ):
+        return 'CoroutineMemory( %s, %d steps, +%d -%d bytes )' % \
+               (self.key, self.steps, self.allocated, self.freed)
+
+
+
+# Live memory by coroutine function, see MemoryProfiler.snapshot()
+class MemorySnapshot( object ):
+    def __init__( self, stats ):
+        self.time = monotonic()
+        self.stats = stats      # key -> (bytes, blocks)
+
+
+    def total( self ):
+        return sum( size for size, blocks in self.stats.values() )
+
+
+    # [ (key, bytes diff, blocks diff), .. ] biggest growth first
+    def compareTo( self, old ):
+        res = []
+        for key in set( self.stats ) | set( old.stats ):
+            size, blocks = self.stats.get( key, (0, 0) )
+            oldSize, oldBlocks = old.stats.get( key, (0, 0) )
+            if size != oldSize or blocks != oldBlocks:
+                res.append( (key, size - oldSize, blocks - oldBlocks) )
+
+        res.sort( key = lambda e: -e[1] )
+        return res
+
+
+    def top( self, limit = 10 ):
+        return sorted( self.stats.items(), key = lambda e: -e[1][0] )[ :limit ]
+
+
+
+# Tags memory with coroutine functions.
+#
+# With tracemalloc:
+# Task.run steps: traced memory growth and decrease by the top coroutine
+# of the step, allocation rates.
+# Live memory: snapshot() attributes every live block to the innermost
+# coroutine frame of its allocation traceback.
+#
+# Without tracemalloc (stock python 2): snapshot() attributes objects held
+# by frame locals of live tasks and branches, innermost coroutine first.
+# Objects behind instances are not followed, no step rates.
+#
+# Usage:
+#   profiler = MemoryProfiler( scheduler )
+#   profiler.start()
+#   before = profiler.snapshot()
+#   ...
+#   for key, size, blocks in profiler.snapshot().compareTo( before ):
+#       print key, size, blocks
+#   print profiler.formatRates()
+#   profiler.stop()
+class MemoryProfiler( object ):
+    def __init__( self, scheduler, frames = MEMORY_TRACE_FRAMES ):
+        self.scheduler = scheduler
+        self.frames = frames
+        self.steps = {}         # key -> CoroutineMemory
+        self.lines = {}         # (filename, line) -> coroutine key
+        self.codes = {}         # seen coroutine code -> key
+        self.stepKey = None
+        self.stepTraced = 0
+        self.started = None
+        self.ownTracing = False
+        self.tracing = tracemalloc is not None
+
+
+    def start( self ):
+        self.started = monotonic()
+        if not self.tracing:
+            return
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start( self.frames )
+            self.ownTracing = True
+
+        self.scheduler.profiler = self
+
+
+    def stop( self ):
+        if self.scheduler.profiler is self:
+            self.scheduler.profiler = None
+        if self.ownTracing:
+            tracemalloc.stop()
+            self.ownTracing = False
+
+
+    # Scheduler hooks
+    def stepStarted( self, task ):
+        code = task.coroutine.gi_code
+        if code not in self.codes:
+            self.addCode( code )
+        for c in task.stack:
+            if c.gi_code not in self.codes:
+                self.addCode( c.gi_code )
+
+        self.stepKey = code
+        self.stepTraced = tracemalloc.get_traced_memory()[ 0 ]
+
+
+    def stepDone( self, task ):
+        # started inside the step
+        if self.stepKey is None:
+            return
+
+        delta = tracemalloc.get_traced_memory()[ 0 ] - self.stepTraced
+        # subcoroutines started during the step
+        if task.coroutine.gi_code not in self.codes:
+            self.addCode( task.coroutine.gi_code )
+
+        key = self.codes[ self.stepKey ]
+        self.stepKey = None
+        m = self.steps.get( key )
+        if m is None:
+            m = self.steps[ key ] = CoroutineMemory( key )
+
+        m.steps += 1
+        if delta > 0:
+            m.allocated += delta
+        else:
+            m.freed -= delta
+
+
+    def addCode( self, code ):
+        key = self.codes[ code ] = codeKey( code )
+        for offset, line in findlinestarts( code ):
+            self.lines[ (code.co_filename, line) ] = key
+
+
+    # Live memory by coroutine function
+    def snapshot( self ):
+        if not self.tracing:
+            return self.framesSnapshot()
+
+        snapshot = tracemalloc.take_snapshot()
+        snapshot = snapshot.filter_traces( (tracemalloc.Filter(False, tracemalloc.__file__),
+                                            tracemalloc.Filter(False, __file__)) )
+        stats = {}
+        for stat in snapshot.statistics( 'traceback' ):
+            frames = stat.traceback
+            if INNERMOST_LAST:
+                frames = reversed( frames )
+
+            # innermost coroutine frame
+            for frame in frames:
+                key = self.lines.get( (frame.filename, frame.lineno) )
+                if key is not None:
+                    break
+            else:
+                key = OTHER
+
+            size, blocks = stats.get( key, (0, 0) )
+            stats[ key ] = (size + stat.size, blocks + stat.count)
+
+        return MemorySnapshot( stats )
+
+
+    # Memory held by frame locals, without tracemalloc
+    def framesSnapshot( self ):
+        frames = []
+        for t in list( self.scheduler.registry.values() ):
+            frames.append( t )
+            if isinstance( t.waitingOn, Parallel ):
+                frames.extend( t.waitingOn.branches )
+
+        stats = {}
+        seen = set()
+        for f in frames:
+            # innermost coroutine first
+            for c in [ f.coroutine ] + list( reversed(f.stack) ):
+                frame = c.gi_frame
+                if frame is None:
+                    continue
+
+                size, blocks = heldSize( frame.f_locals.values(), seen )
+                key = codeKey( c.gi_code )
+                oldSize, oldBlocks = stats.get( key, (0, 0) )
+                stats[ key ] = (oldSize + size, oldBlocks + blocks)
+
+        return MemorySnapshot( stats )
+
+
+    # [ (key, allocated bytes per second, net bytes per second), .. ]
+    def rates( self ):
+        elapsed = max( monotonic() - self.started, 0.000001 )
+        res = [ (m.key, m.allocated / elapsed, m.net() / elapsed) for m in self.steps.values() ]
+        res.sort( key = lambda e: -e[1] )
+        return res
+
+
+    def formatRates( self, limit = 10 ):
+        return ''.join( '%12.0f B/s allocated %12.0f B/s net  %s\n' % (alloc, net, key)
+                        for key, alloc, net in self.rates()[ :limit ] )
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Scheduler health metrics: cheap always-on histograms
+# with Prometheus text format export.
+#
+# GNU LGPL v. 2.1
+
+import os
+import threading
+from bisect import bisect_left
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from PyQt4.QtCore import QObject
+
+
+# Exported metric names prefix
+METRICS_PREFIX = 'pyqtcoroutines_'
+
+
+# Bucket upper bounds, seconds: 50us .. ~13s
+LATENCY_BUCKETS = tuple( 0.00005 * 2 ** i for i in xrange( 19 ) )
+
+
+# Bucket upper bounds for queue depths and counters: 1 .. 65536
+COUNT_BUCKETS = tuple( 2 ** i for i in xrange( 17 ) )
+
+
+
+class Histogram( object ):
+    def __init__( self, name, help, bounds ):
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        self.reset()
+
+
+    def reset( self ):
+        # last one is +Inf bucket
+        self.counts = [ 0 ] * (len( self.bounds ) + 1)
+        self.count = 0
+        self.sum = 0
+
+
+    def observe( self, v ):
+        self.counts[ bisect_left(self.bounds, v) ] += 1
+        self.count += 1
+        self.sum += v
+
+
+    # Bucket upper bound estimation of q quantile
+    def quantile( self, q ):
+        if not self.count:
+            return 0
+
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate( self.counts ):
+            seen += c
+            if seen >= rank:
+                if i < len( self.bounds ):
+                    return self.bounds[ i ]
+                break
+
+        return float( 'inf' )
+
+
+    def snapshot( self ):
+        return { 'count': self.count,
+                 'sum': self.sum,
+                 'buckets': zip( self.bounds + (float('inf'),), self.counts ),
+                 'p50': self.quantile( 0.5 ),
+                 'p99': self.quantile( 0.99 ) }
+
+
+    def formatPrometheus( self ):
+        name = METRICS_PREFIX + self.name
+        lines = [ '# HELP %s %s' % (name, self.help),
+                  '# TYPE %s histogram' % name ]
+        cumulative = 0
+        for bound, c in zip( self.bounds, self.counts ):
+            cumulative += c
+            lines.append( '%s_bucket{le="%g"} %d' % (name, bound, cumulative) )
+
+        lines.append( '%s_bucket{le="+Inf"} %d' % (name, self.count) )
+        lines.append( '%s_sum %g' % (name, self.sum) )
+        lines.append( '%s_count %d' % (name, self.count) )
+        return '\n'.join( lines )
+
+
+    def __repr__( self ):
+        return 'Histogram( %s, %d observations, p50 %g, p99 %g )' % \
+               (self.name, self.count, self.quantile(0.5), self.quantile(0.99))
+
+
+
+# Scheduler metrics.
+# Always on, Scheduler feeds histograms directly.
+class SchedulerMetrics( object ):
+    def __init__( self ):
+        self.lag = Histogram( 'event_loop_lag_seconds',
+                              'Delay between scheduler tick request and tick start.',
+                              LATENCY_BUCKETS )
+        self.readyDepth = Histogram( 'ready_queue_depth',
+                                     'Ready tasks at the scheduler tick start.',
+                                     COUNT_BUCKETS )
+        self.stepsPerTick = Histogram( 'steps_per_tick',
+                                       'Task steps executed per scheduler tick.',
+                                       COUNT_BUCKETS )
+        self.waitToRun = Histogram( 'task_wait_to_run_seconds',
+                                    'Delay between task wakeup and its next step.',
+                                    LATENCY_BUCKETS )
+        self.histograms = [ self.lag, self.readyDepth, self.stepsPerTick, self.waitToRun ]
+
+        # name -> (help, callable)
+        self.gauges = {}
+
+
+    def addGauge( self, name, help, func ):
+        self.gauges[ name ] = (help, func)
+
+
+    def reset( self ):
+        for h in self.histograms:
+            h.reset()
+
+
+    def snapshot( self ):
+        res = {}
+        for h in self.histograms:
+            res[ h.name ] = h.snapshot()
+        for name, (help, func) in self.gauges.iteritems():
+            res[ name ] = func()
+        return res
+
+
+    def formatPrometheus( self ):
+        parts = []
+        for name, (help, func) in sorted( self.gauges.iteritems() ):
+            name = METRICS_PREFIX + name
+            parts.append( '# HELP %s %s\n# TYPE %s gauge\n%s %g' % (name, help, name, name, func()) )
+        for h in self.histograms:
+            parts.append( h.formatPrometheus() )
+        return '\n'.join( parts ) + '\n'
+
+
+    # Atomic replace, so collectors never see half written file
+    def writePrometheus( self, path ):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        f = open( tmp, 'w' )
+        try:
+            f.write( self.formatPrometheus() )
+        finally:
+            f.close()
+        os.rename( tmp, path )
+
+
+    def __repr__( self ):
+        return 'SchedulerMetrics( %s )' % ', '.join( repr(h) for h in self.histograms )
+
+
+
+# Periodically dumps metrics into Prometheus textfile.
+#
+# Usage:
+#   writer = MetricsFileWriter( scheduler.metrics, '/var/lib/node_exporter/app.prom', 10000 )
+class MetricsFileWriter( QObject ):
+    def __init__( self, metrics, path, intervalMs, parent = None ):
+        QObject.__init__( self, parent )
+        self.metrics = metrics
+        self.path = path
+        self.timerId = self.startTimer( intervalMs )
+
+
+    def timerEvent( self, e ):
+        self.metrics.writePrometheus( self.path )
+
+
+    def stop( self ):
+        self.killTimer( self.timerId )
+
+
+
+class MetricsRequestHandler( BaseHTTPRequestHandler ):
+    def do_GET( self ):
+        if self.path not in ( '/', '/metrics' ):
+            self.send_error( 404 )
+            return
+
+        body = self.server.metrics.formatPrometheus()
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', 'text/plain; version=0.0.4' )
+        self.send_header( 'Content-Length', str(len(body)) )
+        self.end_headers()
+        self.wfile.write( body )
+
+
+    # keep stderr clean
+    def log_message( self, format, *args ):
+        pass
+
+
+
+# Serves metrics on localhost from the own thread,
+# so it answers even while the qt loop is blocked.
+#
+# Usage:
+#   server = MetricsServer( scheduler.metrics, 9100 )
+#   ...
+#   server.stop()
+class MetricsServer( object ):
+    def __init__( self, metrics, port = 0, host = '127.0.0.1' ):
+        self.httpd = HTTPServer( (host, port), MetricsRequestHandler )
+        self.httpd.metrics = metrics
+        self.port = self.httpd.server_address[ 1 ]
+
+        self.thread = threading.Thread( target = self.httpd.serve_forever, name = 'MetricsServer' )
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop( self ):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Pooled HTTP client for coroutines.
+#
+# GNU LGPL v. 2.1
+
+import weakref
+from functools import partial
+from collections import deque
+from PyQt4.QtCore import QObject, QUrl
+from PyQt4.QtNetwork import QNetworkAccessManager, QNetworkRequest, QNetworkReply
+from coroutines import AsynchronousCall, Return
+
+
+# Max simultaneous requests of HttpClient
+HTTP_MAX_CONNECTIONS = 32
+
+
+# Max simultaneous requests to one host:port.
+# QNetworkAccessManager keeps up to 6 keep-alive connections per host,
+# more would wait inside qt, not counting our timeouts.
+HTTP_MAX_PER_HOST = 6
+
+
+# Request fails, if no progress (queue, connect, headers, body) that long
+HTTP_TIMEOUT_MS = 30000
+
+
+# HttpRequest.read() default chunk, also reply read buffer
+HTTP_CHUNK_SIZE = 64 * 1024
+
+
+
+class HttpError( Exception ):
+    def __init__( self, url, message ):
+        Exception.__init__( self, '%s: %s' % (url, message) )
+        self.url = url
+        self.message = message
+
+
+
+class HttpTimeout( HttpError ):
+    def __init__( self, url, timeoutMs ):
+        HttpError.__init__( self, url, 'no progress in %d ms' % timeoutMs )
+
+
+
+# PyQt4 QVariant api v1 compatible int
+def variantInt( v ):
+    if hasattr( v, 'toInt' ):
+        v, ok = v.toInt()
+        if not ok:
+            return 0
+    return v or 0
+
+
+
+# Usage:
+#   response = yield client.get( url )   # wakes up, when headers arrived
+#   print response.status, response.responseHeaders
+#   while True:
+#       chunk = yield response.read()    # '' at the end of body
+#       if not chunk:
+#           break
+#       ...
+#
+# Raises HttpError on network errors, HttpTimeout after timeoutMs without progress.
+# Full body buffer waiting for read() is not a timeout.
+# HTTP error statuses (404, 500, ..) are normal responses.
+# Read body to the end or close() the response to free the reply.
+# Dropped or cancelled responses are aborted and free the slot too.
+class HttpRequest( AsynchronousCall ):
+    # buffered body chunks complete inside handle()
+    inlineWakeup = True
+
+    def __init__( self, client, method, url, body = None, headers = None, timeoutMs = HTTP_TIMEOUT_MS ):
+        AsynchronousCall.__init__( self )
+        self.client = client
+        self.method = method
+        self.url = QUrl( url )
+        self.body = body
+        self.headers = headers or {}
+        self.timeoutMs = timeoutMs
+        # qt pools http and https connections separately
+        https = str( self.url.scheme() ).lower() == 'https'
+        self.hostKey = (str(self.url.host()), self.url.port( https and 443 or 80 ))
+
+        self.reply = None
+        self.dropRef = None     # frees the slot, when dropped
+        self.timerId = None
+        self.submitted = False
+        self.active = False     # holds client slot
+        self.finished = False
+        self.error = None       # HttpError, when finished with error
+        self.waiting = None     # None, 'headers' or 'read'
+        self.readSize = 0
+
+        # response
+        self.status = 0
+        self.responseHeaders = {}
+
+
+    def handle( self ):
+        if not self.submitted:
+            self.submitted = True
+            self.waiting = 'headers'
+            self.restartTimer()
+            self.client.admit( self )
+            return
+
+        # yield response.read()
+        self.waiting = 'read'
+        self.deliver()
+
+
+    # called by HttpClient, when connection slot available
+    def start( self ):
+        self.active = True
+        request = QNetworkRequest( self.url )
+        for name, value in self.headers.iteritems():
+            request.setRawHeader( name, value )
+
+        manager = self.client.manager
+        if self.method == 'GET':
+            self.reply = manager.get( request )
+        elif self.method == 'HEAD':
+            self.reply = manager.head( request )
+        elif self.method == 'POST':
+            self.reply = manager.post( request, self.body or '' )
+        elif self.method == 'PUT':
+            self.reply = manager.put( request, self.body or '' )
+        elif self.method == 'DELETE':
+            self.reply = manager.deleteResource( request )
+        else:
+            self.reply = manager.sendCustomRequest( request, self.method )
+
+        # stream: qt stops reading socket, when buffer is full
+        self.reply.setReadBufferSize( self.client.chunkSize * 4 )
+        self.reply.metaDataChanged.connect( self.metaDataChanged )
+        self.reply.readyRead.connect( self.readyRead )
+        self.reply.finished.connect( self.replyFinished )
+
+        # dropped without reading to the end or close(),
+        # the weakref is kept by the client: collected with us, it would not call back
+        self.dropRef = weakref.ref( self, partial(self.client.dropped, self.reply, self.hostKey) )
+        self.client.dropRefs.add( self.dropRef )
+
+
+    # yield response.read( size )
+    def read( self, size = None ):
+        self.readSize = size or self.client.chunkSize
+        return self
+
+
+    # whole body
+    def readAll( self ):
+        chunks = []
+        while True:
+            chunk = yield self.read()
+            if not chunk:
+                break
+            chunks.append( chunk )
+
+        yield Return( ''.join(chunks) )
+
+
+    # Abort body download, release connection slot
+    def close( self ):
+        if self.finished:
+            self.dispose()
+        elif self.reply is None:
+            # still in the client queue
+            if self.submitted:
+                self.client.pending.remove( self )
+            self.finished = True
+            self.stopTimer()
+        else:
+            self.error = HttpError( self.url.toString(), 'closed' )
+            self.reply.abort()
+            self.dispose()
+
+
+    # waiting task is cancelled
+    def cancel( self ):
+        self.waiting = None
+        self.close()
+
+
+    # free buffered body
+    def dispose( self ):
+        if self.reply is not None:
+            self.client.dropRefs.discard( self.dropRef )
+            self.dropRef = None
+            self.reply.deleteLater()
+            self.reply = None
+
+
+    # qt does not read the socket, until read() drains the buffer
+    def bufferFull( self ):
+        return self.reply.bytesAvailable() >= self.reply.readBufferSize()
+
+
+    def readMetaData( self ):
+        self.status = variantInt( self.reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) )
+        self.responseHeaders = dict( (str(k).lower(), str(v)) for k, v in self.reply.rawHeaderPairs() )
+
+
+    def metaDataChanged( self ):
+        self.restartTimer()
+        self.readMetaData()
+        self.deliver()
+
+
+    def readyRead( self ):
+        if self.bufferFull():
+            # waits for read(), not for the server
+            self.stopTimer()
+        else:
+            self.restartTimer()
+        self.deliver()
+
+
+    def deliver( self ):
+        if self.waiting is None:
+            return
+
+        if self.error is not None:
+            self.waiting = None
+            self.dispose()
+            self.wakeup( self.error )
+
+        elif self.waiting == 'headers':
+            if self.status or self.finished:
+                self.waiting = None
+                self.wakeup( self )
+
+        elif self.reply is None:
+            # body is already read
+            self.waiting = None
+            self.wakeup( '' )
+
+        elif self.reply.bytesAvailable():
+            self.waiting = None
+            chunk = str( self.reply.read(self.readSize) )
+            # drained full buffer, wait for the server again
+            if self.timerId is None:
+                self.restartTimer()
+            self.wakeup( chunk )
+
+        elif self.finished:
+            self.waiting = None
+            self.dispose()
+            self.wakeup( '' )
+
+
+    def replyFinished( self ):
+        if self.finished:
+            return
+
+        self.finished = True
+        self.stopTimer()
+
+        if self.error is None and self.reply.error() != QNetworkReply.NoError:
+            # http statuses are responses, not errors
+            self.readMetaData()
+            if not self.status:
+                self.error = HttpError( self.url.toString(), str(self.reply.errorString()) )
+
+        self.client.release( self )
+        self.deliver()
+
+
+    def restartTimer( self ):
+        if not self.timeoutMs or self.finished:
+            return
+
+        self.stopTimer()
+        self.timerId = self.startTimer( self.timeoutMs )
+
+
+    def stopTimer( self ):
+        if self.timerId is not None:
+            self.killTimer( self.timerId )
+            self.timerId = None
+
+
+    def timerEvent( self, e ):
+        self.stopTimer()
+        self.error = HttpTimeout( self.url.toString(), self.timeoutMs )
+        if self.reply is not None:
+            # emits finished
+            self.reply.abort()
+            return
+
+        # timeout in the client queue
+        self.client.pending.remove( self )
+        self.finished = True
+        self.deliver()
+
+
+    def __repr__( self ):
+        return 'HttpRequest( %s %s, status %d )' % (self.method, self.url.toString(), self.status)
+
+
+
+# One QNetworkAccessManager shares keep-alive connections per host.
+# HttpClient limits simultaneous requests globally and per host,
+# excess requests wait in the queue.
+#
+# Usage:
+#   client = HttpClient()
+#   body = yield client.fetch( 'http://google.com' )
+class HttpClient( QObject ):
+    def __init__( self, parent = None, maxConnections = HTTP_MAX_CONNECTIONS,
+                  maxPerHost = HTTP_MAX_PER_HOST, chunkSize = HTTP_CHUNK_SIZE ):
+        QObject.__init__( self, parent )
+        self.manager = QNetworkAccessManager( self )
+        self.maxConnections = maxConnections
+        self.maxPerHost = maxPerHost
+        self.chunkSize = chunkSize
+
+        self.active = 0
+        self.activeHosts = {}    # (host, port) -> active requests
+        self.pending = deque()   # waiting HttpRequests, oldest first
+        self.dropRefs = set()    # weakrefs of started HttpRequests
+
+
+    def request( self, method, url, body = None, headers = None, timeoutMs = HTTP_TIMEOUT_MS ):
+        return HttpRequest( self, method, url, body, headers, timeoutMs )
+
+
+    def get( self, url, headers = None, timeoutMs = HTTP_TIMEOUT_MS ):
+        return HttpRequest( self, 'GET', url, None, headers, timeoutMs )
+
+
+    def post( self, url, body, headers = None, timeoutMs = HTTP_TIMEOUT_MS ):
+        return HttpRequest( self, 'POST', url, body, headers, timeoutMs )
+
+
+    # Subcoroutine, returns whole body
+    def fetch( self, url, headers = None, timeoutMs = HTTP_TIMEOUT_MS ):
+        response = yield self.get( url, headers, timeoutMs )
+        body = yield response.readAll()
+        yield Return( body )
+
+
+    def hasSlot( self, hostKey ):
+        return self.active < self.maxConnections and \
+               self.activeHosts.get( hostKey, 0 ) < self.maxPerHost
+
+
+    def admit( self, request ):
+        if self.hasSlot( request.hostKey ):
+            self.acquire( request )
+        else:
+            self.pending.append( request )
+
+
+    def acquire( self, request ):
+        self.active += 1
+        self.activeHosts[ request.hostKey ] = self.activeHosts.get( request.hostKey, 0 ) + 1
+        request.start()
+
+
+    def release( self, request ):
+        if not request.active:
+            return
+
+        request.active = False
+        self.releaseSlot( request.hostKey )
+
+
+    def releaseSlot( self, hostKey ):
+        self.active -= 1
+        left = self.activeHosts[ hostKey ] - 1
+        if left:
+            self.activeHosts[ hostKey ] = left
+        else:
+            del self.activeHosts[ hostKey ]
+
+        self.startPending()
+
+
+    # HttpRequest is garbage, but its reply is not disposed
+    def dropped( self, reply, hostKey, ref ):
+        self.dropRefs.discard( ref )
+        if not reply.isFinished():
+            # slot is released on finished, nobody listens now
+            reply.abort()
+            self.releaseSlot( hostKey )
+        reply.deleteLater()
+
+
+    def startPending( self ):
+        for request in list( self.pending ):
+            if self.active >= self.maxConnections:
+                break
+
+            if self.hasSlot( request.hostKey ):
+                self.pending.remove( request )
+                self.acquire( request )
+
+
+    def __repr__( self ):
+        return 'HttpClient( %d of %d active, %d pending )' % \
+               (self.active, self.maxConnections, len(self.pending))
@@ -8,17 +8,29 @@ if __name__ == '__main__':
 import datetime
 from collections import deque
 from PyQt4.QtCore import QObject
-from satchmo.common_lib.coroutines import AsynchronousCall, Return, Sleep
+from coroutines import AsynchronousCall, Return, Sleep
 
 
 
 class Acquirer( AsynchronousCall ):
+    def __init__( self, sem ):
+        AsynchronousCall.__init__( self )
+        self.sem = sem
+        self.cancelled = False
+
+
     def handle( self ):
         # we're quiet :)
         # Task will scheduled from Semaphore
         pass
 
 
+    # waiting task is cancelled, do not take the next permit
+    def cancel( self ):
+        self.cancelled = True
+        self.sem.pending.remove( self )
+
+
 
 # Semaphore
 class Semaphore:
@@ -59,10 +71,16 @@ class Semaphore:
             self.available -= 1
         else:
             # sleep, until released..
-            acquirer = Acquirer()
+            acquirer = Acquirer( self )
             self.pending.appendleft( acquirer )
             # sleep, until available
-            yield acquirer
+            try:
+                yield acquirer
+            except GeneratorExit:
+                # cancelled after release() passed us the permit
+                if not acquirer.cancelled:
+                    self.release()
+                raise
             done = datetime.datetime.now()
 
         yield Return( self.available, done - start )
@@ -72,7 +90,7 @@ class Semaphore:
 if __name__ == '__main__':
     import random
     from PyQt4.QtGui import QApplication
-    from satchmo.common_lib.coroutines import Scheduler
+    from coroutines import Scheduler
 
 
     def coWorker( name, sem ):
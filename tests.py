@@ -8,14 +8,35 @@
 #
 # Sorry, we can't use unittest,
 # due to qt event loop.
+import gc
 import sys
 import traceback
 import datetime
 import hotshot
 import hotshot.stats
+import urllib2
+import threading
+import time
+import os
+import socket
+import tempfile
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from collections import deque
 from PyQt4.QtCore import QCoreApplication, QObject, QTimer, pyqtSignal
 from coroutines import *
+from cache import singleFlight, SingleFlight
+from semaphore import Semaphore
+from metrics import MetricsServer
+from network import HttpClient, HttpTimeout
+from filestream import FileStream, chunkBytes
+from watchdog import StallWatchdog
+from tracer import TraceRecorder, loadTrace, chromeTrace
+from hedge import Hedge
+import memprofile
+from StringIO import StringIO
+import exceptionsink
+from exceptionsink import ExceptionSink
 
 
 class Test( QObject ):
@@ -98,6 +119,105 @@ class SpeedTest( Test ):
 
 
 
+class CheckpointSpeedTest( SpeedTest ):
+    def incrementer( self ):
+        self.incrementers += 1
+
+        # counting iterations
+        while self.counting:
+            self.counter += 1
+            yield Checkpoint()
+
+        self.incrementers -= 1
+
+
+
+# Spawn-heavy workload of short-lived tasks.
+# Tasks ending with yield Return() go through the step status,
+# tasks falling off the end raise StopIteration out of the coroutine,
+# like every task did, before Task.run returned step status.
+class ChurnSpeedTest( Test ):
+    def returning( self ):
+        self.finished += 1
+        yield Return( self.finished )
+
+
+    def falling( self ):
+        self.finished += 1
+        return
+        yield
+
+
+    def spawner( self ):
+        rates = []
+        for name, factory in ( ('yield Return', self.returning), ('StopIteration', self.falling) ):
+            self.finished = 0
+            spawned = 0
+            end = monotonic() + 0.5
+            while monotonic() < end:
+                # keep 100 tasks alive
+                for i in xrange( 100 - (spawned - self.finished) ):
+                    self.scheduler.newTask( factory() )
+                    spawned += 1
+                yield
+            rates.append( '%d %s' % (self.finished / 0.5, name) )
+
+            # the rest
+            while self.finished < spawned:
+                yield
+
+        print 'Short tasks churn, tasks per second: %s...' % ', '.join( rates )
+
+
+    def run( self ):
+        self.scheduler.newTask( self.spawner() )
+
+
+
+class FairShareTest( Test ):
+    def run( self ):
+        self.scheduler.setGroupWeight( 'heavy', 3 )
+        self.scheduler.setGroupWeight( 'light', 1 )
+        self.working = True
+        self.longestStep = 0.0
+
+
+        def worker():
+            while self.working:
+                # some cpu work
+                start = monotonic()
+                sum( xrange(2000) )
+                self.longestStep = max( self.longestStep, monotonic() - start )
+                yield
+
+
+        def coTest( scheduler ):
+            for i in xrange( 10 ):
+                scheduler.newTask( worker(), group = 'heavy' )
+            # many tasks in the light group
+            for i in xrange( 100 ):
+                scheduler.newTask( worker(), group = 'light' )
+
+            yield Sleep( 300 )
+            self.working = False
+
+            heavy = scheduler.getGroup( 'heavy' )
+            light = scheduler.getGroup( 'light' )
+            print 'heavy/light cpu time %.2f (weights 3/1)...' % (heavy.cpuTime / light.cpuTime)
+
+            # both groups were busy all the time: the group with the least vtime
+            # runs next, vtimes differ by one step at most, whatever the loop speed
+            gap = abs( heavy.vtime - light.vtime )
+            # step runtime includes scheduler bookkeeping
+            assert gap <= self.longestStep + 0.001, (heavy.vtime, light.vtime, self.longestStep)
+            assert heavy.steps > light.steps > 0, (heavy.steps, light.steps)
+            assert scheduler.groupUsage()[ 'light' ][ 'spawned' ] == 100
+
+
+        self.scheduler.newTask( coTest(self.scheduler) )
+
+
+
 class AsyncCallTest( Test ):
     def run( self ):
         # must correctly return argument value
@@ -251,6 +371,426 @@ class WaitTaskTest( Test ):
 
 
 
+class InlineWaitSpeedTest( Test ):
+    def run( self ):
+        # old behaviour: wakeup always goes through Scheduler.schedule
+        class DeferredWaitTask( WaitTask ):
+            inlineWakeup = False
+
+
+        def returner():
+            yield Return( 'ok' )
+
+
+        def waiter( scheduler, waitCall ):
+            t = scheduler.newTask( returner() )
+            yield WaitTask( t )
+
+            # cache-hit style waits
+            count = 0
+            end = monotonic() + 0.3
+            while monotonic() < end:
+                for i in xrange( 100 ):
+                    res = yield waitCall( t )
+                    assert res == 'ok'
+                count += 100
+
+            yield Return( count / 0.3 )
+
+
+        def coTest( scheduler ):
+            deferred = yield waiter( scheduler, DeferredWaitTask )
+            inline = yield waiter( scheduler, WaitTask )
+            print 'WaitTask on done task: %d waits per second deferred, %d inline...' % (deferred, inline)
+
+
+        self.scheduler.newTask( coTest(self.scheduler) )
+
+
+
+class WakeupLatencyTest( Test ):
+    def run( self ):
+        # wakeup() from outside of the scheduler tick
+        class ExternalWakeup( AsynchronousCall ):
+            def handle( self ):
+                self.scheduler.callThreadsafe( self.wake )
+            def wake( self ):
+                self.wokenAt = monotonic()
+                self.wakeup()
+
+
+        def pinger( count ):
+            total = 0
+            for i in xrange( count ):
+                call = ExternalWakeup()
+                yield call
+                total += monotonic() - call.wokenAt
+
+            yield Return( total / count )
+
+
+        def coTest( scheduler, legacy ):
+            try:
+                timer = yield WaitTask( legacy.newTask(pinger(2000)) )
+                event = yield WaitTask( scheduler.newTask(pinger(2000)) )
+            finally:
+                # legacy scheduler is idle, its tick timer is killed
+                legacy.deleteLater()
+                self.legacy = None
+
+            print 'wakeup() to resume: %.1f us zero timer, %.1f us posted event...' % (timer * 1e6, event * 1e6)
+            # posted event does not wait for the timers pass of the event loop,
+            # loose bound, the loop may be busy with other events
+            assert event < timer + 1e-3, (timer, event)
+
+
+        self.legacy = Scheduler()
+        self.legacy.useTimer = True
+        self.scheduler.newTask( coTest(self.scheduler, self.legacy) )
+
+
+
+class PeriodicTest( Test ):
+    def quick( self ):
+        yield
+
+
+    def slow( self ):
+        yield Sleep( 70 )
+
+
+    def counted( self ):
+        self.active += 1
+        self.maxActive = max( self.maxActive, self.active )
+        try:
+            yield Sleep( 30 )
+        finally:
+            self.active -= 1
+
+
+    def coTest( self ):
+        s = self.scheduler
+        self.active = self.maxActive = 0
+        skip = s.every( 20, self.quick, Scheduler.MISSED_SKIP )
+        coalesce = s.every( 20, self.quick, Scheduler.MISSED_COALESCE )
+        catchup = s.every( 20, self.quick, Scheduler.MISSED_CATCHUP )
+        guarded = s.every( 20, self.slow, jitterMs = 10 )
+        owing = s.every( 20, self.counted, Scheduler.MISSED_CATCHUP )
+
+        yield Sleep( 100 )
+        # stall the loop for 10 ticks
+        time.sleep( 0.2 )
+        yield Sleep( 100 )
+
+        for job in ( skip, coalesce, catchup, guarded, owing ):
+            job.cancel()
+
+        print 'Periodic runs: %d skip, %d coalesce, %d catch up...' % (skip.runs, coalesce.runs, catchup.runs)
+        assert skip.skipped >= 5, skip
+        assert coalesce.skipped >= 5, coalesce
+        assert catchup.runs > coalesce.runs + 3, (catchup, coalesce)
+        assert guarded.overlapped and guarded.runs < 10, guarded
+        # owed catch up runs do not overlap
+        assert owing.overlapped and self.maxActive == 1, (owing, self.maxActive)
+        # cancelled jobs leave the heap and the timer
+        assert not s.periodic and s.periodicTimerId is None, s.periodic
+
+
+    def run( self ):
+        self.scheduler.newTask( self.coTest() )
+
+
+
+class FutureTest( Test ):
+    def waiter( self, future ):
+        value = yield future
+        self.woken += 1
+        yield Return( value )
+
+
+    def failing( self, future ):
+        try:
+            yield future
+        except ValueError:
+            self.failed += 1
+
+
+    def coTest( self ):
+        self.woken = 0
+        self.failed = 0
+        future = Future()
+        called = []
+        future.addCallback( called.append )
+
+        for i in xrange( 1000 ):
+            self.scheduler.newTask( self.waiter(future) )
+
+        # let waiters park
+        yield Sleep( 10 )
+        assert self.scheduler.waitSummary() == { 'Future': 1000 }, self.scheduler.waitSummary()
+
+        start = monotonic()
+        future.setResult( 7 )
+        assert called == [ future ] and future.result() == 7
+        yield Sleep( 10 )
+        assert self.woken == 1000, self.woken
+        print '1000 Future waiters woken in %.1f ms...' % ((monotonic() - start) * 1000)
+
+        # done future resumes in place
+        value = yield future
+        assert value == 7
+
+        failure = Future()
+        tasks = [ self.scheduler.newTask(self.failing(failure)) for i in xrange(10) ]
+        yield
+        failure.setException( ValueError('oops') )
+        yield WaitTask( tasks[-1] )
+        assert self.failed == 10, self.failed
+
+
+    def run( self ):
+        self.scheduler.newTask( self.coTest() )
+
+
+
+class CancelTest( Test ):
+    def sleeper( self ):
+        try:
+            yield Sleep( 1000 )
+        finally:
+            self.released += 1
+
+
+    def nested( self, future ):
+        try:
+            yield self.sleeperOn( future )
+        finally:
+            self.released += 1
+
+
+    def sleeperOn( self, future ):
+        try:
+            yield future
+        finally:
+            self.released += 1
+
+
+    def acquirer( self, sem ):
+        yield sem.acquire()
+        yield Sleep( 1000 )
+
+
+    def slowValue( self ):
+        yield Sleep( 20 )
+        yield Return( 1 )
+
+
+    def coTest( self ):
+        self.released = 0
+
+        # parked on AsynchronousCall
+        t = self.scheduler.newTask( self.sleeper() )
+        yield
+        assert t.cancel() and not t.cancel()
+        assert self.released == 1 and t.state == Task.CANCELLED
+        try:
+            yield WaitTask( t )
+            assert False, 'TaskCancelled expected'
+        except TaskCancelled:
+            pass
+
+        # parked on Future in subcoroutine
+        future = Future()
+        t = self.scheduler.newTask( self.nested(future) )
+        yield
+        t.cancel()
+        assert self.released == 3 and not future.waiters
+
+        # ready
+        t = self.scheduler.newTask( self.sleeper() )
+        t.cancel()
+        assert self.scheduler.readyCount == 0, self.scheduler.readyCount
+
+        # parked on Semaphore, does not take the permit
+        sem = Semaphore( 1 )
+        yield sem.acquire()
+        t = self.scheduler.newTask( self.acquirer(sem) )
+        yield
+        t.cancel()
+        assert not sem.pending
+        sem.release()
+        assert sem.available == 1, sem
+
+        # woken by release(), cancelled before resume
+        yield sem.acquire()
+        t = self.scheduler.newTask( self.acquirer(sem) )
+        yield
+        sem.release()
+        t.cancel()
+        assert sem.available == 1, sem
+
+        # single flight waiter
+        flight = SingleFlight( self.slowValue )
+        leader = self.scheduler.newTask( flight() )
+        t = self.scheduler.newTask( flight() )
+        yield
+        t.cancel()
+        assert not flight.flights[ () ].waiters
+        assert (yield WaitTask( leader )) == 1
+
+
+    def run( self ):
+        self.scheduler.newTask( self.coTest() )
+
+
+
+class HedgeTest( Test ):
+    def attempt( self, delays ):
+        ms, value = delays.pop( 0 )
+        try:
+            yield Sleep( ms )
+            self.slept.append( value )
+        finally:
+            self.finished += 1
+        yield Return( value )
+
+
+    def coTest( self ):
+        self.finished = 0
+        self.slept = []
+
+        # slow first attempt, fast backup
+        hedge = Hedge( self.scheduler, self.attempt, delayMs = 20, maxExtraLoad = 0.5 )
+        start = monotonic()
+        value = yield hedge.run( [ (500, 'slow'), (5, 'fast') ] )
+        print 'Hedged call: %.0f ms, slow attempt 500 ms...' % ((monotonic() - start) * 1000)
+        assert value == 'fast', value
+        assert hedge.hedged == 1 and hedge.hedgeWins == 1 and hedge.cancelled == 1, hedge.stats()
+        # the slow attempt was cancelled in its Sleep, not waited for
+        assert self.finished == 2 and self.slept == [ 'fast' ], self.slept
+
+        # no extra load budget left
+        value = yield hedge.run( [ (50, 'slow'), (5, 'fast') ] )
+        assert value == 'slow' and hedge.hedged == 1, hedge.stats()
+        print hedge, '...'
+
+
+    def run( self ):
+        self.scheduler.newTask( self.coTest() )
+
+
+
+class ParallelTest( Test ):
+    def branch( self, value, ms ):
+        yield Sleep( ms )
+        yield Return( value )
+
+
+    def failing( self ):
+        yield Sleep( 1 )
+        raise ValueError( 'branch failed' )
+
+
+    def slow( self ):
+        try:
+            yield Sleep( 1000 )
+        finally:
+            self.released += 1
+
+
+    def leaf( self, i ):
+        yield Return( i )
+
+
+    class BadCall( AsynchronousCall ):
+        def handle( self ):
+            raise KeyError( 'bad call' )
+
+
+    def coTest( self ):
+        self.released = 0
+
+        # ordered results, not completion order
+        a, b, c = yield [ self.branch('a', 20), self.branch('b', 1), self.branch('c', 10) ]
+        assert (a, b, c) == ( 'a', 'b', 'c' )
+
+        results = yield Parallel( self.branch(1, 1), [ self.leaf(2), self.leaf(3) ] )
+        assert results == [ 1, [ 2, 3 ] ], results
+
+        assert (yield []) == []
+
+        # the first exception cancels other branches
+        try:
+            yield [ self.slow(), self.failing(), self.slow() ]
+            assert False, 'ValueError expected'
+        except ValueError:
+            pass
+        assert self.released == 2, self.released
+
+        # failed AsynchronousCall.handle() of a branch
+        try:
+            yield [ self.slow(), self.BadCall() ]
+            assert False, 'KeyError expected'
+        except KeyError:
+            pass
+        assert self.released == 3, self.released
+
+        # fan-out cost: branches vs tasks
+        n = 1000
+        start = monotonic()
+        yield [ self.leaf(i) for i in xrange(n) ]
+        branches = monotonic() - start
+
+        start = monotonic()
+        tasks = [ self.scheduler.newTask(self.leaf(i)) for i in xrange(n) ]
+        for t in tasks:
+            yield WaitTask( t )
+        taskTime = monotonic() - start
+        print 'Fan-out of %d: %.1f ms branches, %.1f ms tasks...' % (n, branches * 1000, taskTime * 1000)
+
+
+    def run( self ):
+        self.scheduler.newTask( self.coTest() )
+
+
+
+class WaitSignalTest( Test ):
+    class Emitter( QObject ):
+        changed = pyqtSignal( int )
+
+        def burst( self ):
+            for i in xrange( 1, 4 ):
+                self.changed.emit( i )
+
+
+    def coTest( self ):
+        e = self.emitter
+
+        QTimer.singleShot( 0, e.burst )
+        args = yield WaitSignal( e.changed )
+        assert args == ( 1, ), args
+
+        QTimer.singleShot( 0, e.burst )
+        args = yield WaitSignal( e.changed, 1000, coalesce = True )
+        assert args == ( 3, ), args
+
+        QTimer.singleShot( 0, e.burst )
+        args = yield WaitSignal( e.changed, 1000, coalesce = True, keepAll = True )
+        assert args == [ (1, ), (2, ), (3, ) ], args
+
+        # timeout
+        call = WaitSignal( e.changed, 10 )
+        args = yield call
+        assert args is None, args
+        assert not call.connected, 'still connected'
+
+
+    def run( self ):
+        self.emitter = self.Emitter()
+        self.scheduler.newTask( self.coTest() )
+
+
+
 class WaitFirstTaskTest( Test ):
     def run( self ):
         def sleeper(s):
@@ -350,6 +890,618 @@ class WaitFirstTaskTest( Test ):
 
 
 
+class SingleFlightTest( Test ):
+    def run( self ):
+        self.calls = 0
+
+        @singleFlight( maxSize = 2, ttl = 10 )
+        def fetch( key ):
+            self.calls += 1
+            yield Sleep( 30 )
+            if key == 'bad':
+                raise Exception( 'bad' )
+            yield Return( key * 2 )
+
+
+        def fetcher( key ):
+            v = yield fetch( key )
+            assert v == key * 2
+
+
+        def badFetcher():
+            try:
+                yield fetch( 'bad' )
+                assert False
+            except Exception, e:
+                assert str(e) == 'bad'
+
+
+        def coTest( scheduler ):
+            # concurrent callers share one execution
+            tasks = [ scheduler.newTask( fetcher('a') ) for i in xrange( 10 ) ]
+            yield coWaitTasks( tasks, 500 )
+            assert self.calls == 1
+
+            # cached
+            v = yield fetch( 'a' )
+            assert v == 'aa'
+            assert self.calls == 1
+
+            # all waiters get the leader's exception
+            tasks = [ scheduler.newTask( badFetcher() ) for i in xrange( 3 ) ]
+            yield coWaitTasks( tasks, 500 )
+            assert self.calls == 2
+
+            # lru eviction
+            yield fetch( 'b' )
+            yield fetch( 'c' )
+            stats = fetch.flight.stats()
+            assert stats[ 'size' ] == 2
+            assert stats[ 'evictions' ] == 1
+            assert stats[ 'coalesced' ] == 11
+            assert not stats[ 'inflight' ]
+
+            # positional tuple is not keyword arguments
+            v1 = yield fetch( ('key', 'x') )
+            v2 = yield fetch( key = 'x' )
+            assert v1 == ( 'key', 'x', 'key', 'x' ) and v2 == 'xx', (v1, v2)
+            assert self.calls == 6, self.calls
+
+
+        self.scheduler.newTask( coTest(self.scheduler) )
+
+
+
+class ThreadsafeScheduleTest( Test ):
+    def run( self ):
+        class Parker( AsynchronousCall ):
+            def __init__( self, parked ):
+                AsynchronousCall.__init__( self )
+                self.parked = parked
+            def handle( self ):
+                self.parked.append( self )
+
+
+        def parker( i, parked ):
+            res = yield Parker( parked )
+            assert res == i
+
+
+        def producer( calls ):
+            for i, call in enumerate( calls ):
+                call.wakeupThreadsafe( i )
+
+
+        def coTest( scheduler ):
+            parked = []
+            tasks = [ scheduler.newTask( parker(i, parked) ) for i in xrange( 1000 ) ]
+            while len( parked ) < len( tasks ):
+                yield
+
+            drains = scheduler.externalDrains
+            thread = threading.Thread( target = producer, args = (parked, ) )
+            thread.start()
+            thread.join()
+
+            yield coWaitTasks( tasks, 500 )
+            # burst is coalesced
+            assert scheduler.externalDrains - drains == 1
+
+
+        self.scheduler.newTask( coTest(self.scheduler) )
+
+
+
+class StandInHttpServer( ThreadingMixIn, HTTPServer ):
+    daemon_threads = True
+
+    def __init__( self ):
+        HTTPServer.__init__( self, ('127.0.0.1', 0), StandInHttpHandler )
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.maxInflight = 0
+        self.url = 'http://127.0.0.1:%d' % self.server_address[ 1 ]
+        self.thread = threading.Thread( target = self.serve_forever, args = (0.05, ) )
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop( self ):
+        self.shutdown()
+        self.server_close()
+
+
+    # aborted requests reset connections
+    def handle_error( self, request, clientAddress ):
+        if not isinstance( sys.exc_info()[ 1 ], socket.error ):
+            HTTPServer.handle_error( self, request, clientAddress )
+
+
+
+class StandInHttpHandler( BaseHTTPRequestHandler ):
+    # keep-alive
+    protocol_version = 'HTTP/1.1'
+
+    bodies = { '/hello': 'hello world',
+               '/big': 'x' * 200000,
+               '/slow': 'slow',
+               '/hang': 'hang' }
+
+
+    def do_GET( self ):
+        server = self.server
+        with server.lock:
+            server.inflight += 1
+            server.maxInflight = max( server.maxInflight, server.inflight )
+
+        try:
+            if self.path == '/slow':
+                time.sleep( 0.05 )
+            elif self.path == '/hang':
+                time.sleep( 0.5 )
+
+            body = self.bodies.get( self.path )
+            self.send_response( body is None and 404 or 200 )
+            body = body or 'not found'
+            self.send_header( 'Content-Length', str(len(body)) )
+            self.end_headers()
+        finally:
+            with server.lock:
+                server.inflight -= 1
+
+        self.wfile.write( body )
+
+
+    def log_message( self, format, *args ):
+        pass
+
+
+
+class HttpClientTest( Test ):
+    def run( self ):
+        self.server = StandInHttpServer()
+        self.client = HttpClient( maxPerHost = 2 )
+
+
+        def coTest( scheduler, client, server ):
+            try:
+                body = yield client.fetch( server.url + '/hello' )
+                assert body == 'hello world'
+
+                # streaming body
+                response = yield client.get( server.url + '/big' )
+                assert response.status == 200
+                assert response.responseHeaders[ 'content-length' ] == '200000'
+                size = 0
+                while True:
+                    chunk = yield response.read( 4096 )
+                    if not chunk:
+                        break
+                    assert len( chunk ) <= 4096
+                    size += len( chunk )
+                assert size == 200000
+
+                # http error status is a response
+                response = yield client.get( server.url + '/missing' )
+                assert response.status == 404
+                response.close()
+
+                # per host limit
+                server.maxInflight = 0
+                tasks = [ scheduler.newTask( client.fetch(server.url + '/slow') ) for i in xrange( 6 ) ]
+                yield coWaitTasks( tasks, 1000 )
+                assert server.maxInflight == 2
+                assert not client.active
+                assert not client.pending
+
+                try:
+                    yield client.fetch( server.url + '/hang', timeoutMs = 100 )
+                    assert False
+                except HttpTimeout:
+                    pass
+                assert not client.active
+
+                # qt pools http and https separately
+                assert client.get( 'https://example.com/' ).hostKey == ( 'example.com', 443 )
+                assert client.get( 'http://example.com/' ).hostKey == ( 'example.com', 80 )
+
+                # never yielded
+                client.get( server.url + '/hello' ).close()
+
+                # slow consumer: full body buffer is not a timeout
+                slow = HttpClient( chunkSize = 4096 )
+                response = yield slow.get( server.url + '/big', timeoutMs = 100 )
+                yield Sleep( 300 )
+                body = yield response.readAll()
+                assert len( body ) == 200000
+
+                # dropped response frees the slot
+                response = yield slow.get( server.url + '/big' )
+                assert slow.active == 1
+                del response
+                yield Sleep( 1 )
+                gc.collect()
+                assert not slow.active and not slow.dropRefs, slow
+            finally:
+                server.stop()
+
+
+        self.scheduler.newTask( coTest(self.scheduler, self.client, self.server) )
+
+
+
+class FileStreamTest( Test ):
+    def run( self ):
+        fd, self.path = tempfile.mkstemp()
+        lines = [ 'line %d' % i for i in xrange( 10000 ) ]
+        content = '\n'.join( lines )
+        os.write( fd, content )
+        os.close( fd )
+
+
+        def coTest( path ):
+            try:
+                for useMmap in ( True, False ):
+                    # chunks
+                    stream = FileStream( path, 4096, useMmap )
+                    assert (stream.mm is not None) == useMmap
+                    data = []
+                    while True:
+                        chunk = yield stream.read()
+                        if not chunk:
+                            break
+                        assert len( chunk ) <= 4096
+                        data.append( chunkBytes(chunk) )
+                    stream.close()
+                    assert ''.join( data ) == content
+
+                    # lines
+                    stream = FileStream( path, 4096, useMmap )
+                    res = []
+                    while True:
+                        chunkLines = yield stream.readLines()
+                        if not chunkLines:
+                            break
+                        res.extend( chunkLines )
+                    stream.close()
+                    assert res == lines
+
+                # pipe: size is 0, read until the writer closes it
+                fifo = path + '.fifo'
+                os.mkfifo( fifo )
+                writer = threading.Thread( target = lambda: open(fifo, 'wb').write(content) )
+                writer.start()
+                try:
+                    stream = FileStream( fifo, 4096 )
+                    assert stream.mm is None and not stream.size
+                    data = []
+                    while True:
+                        chunk = yield stream.read()
+                        if not chunk:
+                            break
+                        data.append( chunkBytes(chunk) )
+                    stream.close()
+                    assert ''.join( data ) == content
+                finally:
+                    writer.join()
+                    os.unlink( fifo )
+
+                # read error is raised by every later read()
+                if os.path.exists( '/proc/self/mem' ):
+                    stream = FileStream( '/proc/self/mem', 4096 )
+                    for i in xrange( 2 ):
+                        try:
+                            yield stream.read()
+                            assert False, 'IOError expected'
+                        except IOError:
+                            pass
+                    stream.close()
+            finally:
+                os.unlink( path )
+
+
+        self.scheduler.newTask( coTest(self.path) )
+
+
+
+class TracerTest( Test ):
+    def sleeper( self ):
+        yield Sleep( 5 )
+        yield Return( 1 )
+
+
+    def coTest( self ):
+        tracer = TraceRecorder()
+        tracer.attach( self.scheduler )
+        t = self.scheduler.newTask( self.sleeper() )
+        yield WaitTask( t )
+        tracer.detach()
+
+        fd, path = tempfile.mkstemp()
+        os.close( fd )
+        try:
+            tracer.save( path )
+            names, records, lost = loadTrace( path )
+        finally:
+            os.unlink( path )
+        assert not lost and records == tracer.records()
+
+        trace = chromeTrace( names, records )['traceEvents']
+        slices = [ e['name'] for e in trace if e['ph'] == 'X' and e['tid'] == t.tid ]
+        assert slices == [ 'ready', 'run', 'Sleep', 'ready', 'run' ], slices
+        instants = [ e['name'] for e in trace if e['ph'] == 'i' and e['tid'] == t.tid ]
+        assert instants == [ 'spawn', 'wakeup', 'done' ], instants
+
+        # ring buffer keeps the last records
+        ring = TraceRecorder( 4 )
+        for i in xrange( 10 ):
+            ring.record( 1, i )
+        assert [ r[2] for r in ring.records() ] == [ 6, 7, 8, 9 ]
+
+
+    def run( self ):
+        self.scheduler.newTask( self.coTest() )
+
+
+
+class MemoryProfileTest( Test ):
+    def holder( self, release ):
+        kept = []
+        for i in xrange( 10 ):
+            kept.append( bytearray(10000) )
+            yield
+
+        # keep the memory, until the snapshot
+        yield release
+
+
+    def coTest( self ):
+        profiler = memprofile.MemoryProfiler( self.scheduler )
+        profiler.start()
+        try:
+            before = profiler.snapshot()
+            release = Future()
+            t = self.scheduler.newTask( self.holder(release) )
+            yield Sleep( 10 )
+            growth = profiler.snapshot().compareTo( before )
+            release.setResult()
+            yield WaitTask( t )
+        finally:
+            profiler.stop()
+
+        key, size, blocks = growth[ 0 ]
+        assert key.startswith( 'holder ' ) and size >= 100000, growth
+        if profiler.tracing:
+            assert profiler.rates()[ 0 ][ 0 ] == key, profiler.rates()
+        print 'holder() keeps %d bytes in %d blocks (%s)...' % \
+              (size, blocks, profiler.tracing and 'tracemalloc' or 'frames')
+
+
+    def run( self ):
+        self.scheduler.newTask( self.coTest() )
+
+
+
+class ExceptionSinkTest( Test ):
+    def failing( self, i ):
+        raise ValueError( 'downstream is down' )
+        yield
+
+
+    def other( self ):
+        raise KeyError( 'other' )
+        yield
+
+
+    def survivor( self ):
+        self.survived = True
+        yield
+
+
+    def coTest( self ):
+        self.survived = False
+        stream = StringIO()
+        # the whole storm is one batch
+        sink = ExceptionSink( stream, maxQueued = 900, interval = 60 )
+        self.scheduler.exceptionSink = sink
+        self.scheduler.raiseCoException = False
+        try:
+            start = monotonic()
+            self.scheduler.newTask( self.other() )
+            tasks = [ self.scheduler.newTask( self.failing(i) ) for i in xrange(1000) ]
+            self.scheduler.newTask( self.survivor() )
+            while not self.survived:
+                yield
+            elapsed = monotonic() - start
+        finally:
+            self.scheduler.exceptionSink = None
+            self.scheduler.raiseCoException = True
+
+        # failed tasks do not stop the tick
+        assert sink.reported == 1001 and sink.dropped == 101, sink
+        assert all( t.state == Task.EXCEPTION for t in tasks )
+        print '1001 failing tasks in %.1f ms...' % (elapsed * 1000)
+
+        # nothing written in the scheduler thread
+        assert not stream.getvalue()
+        sink.flush()
+        out = stream.getvalue()
+        assert out.count( 'UNHANDLED COROUTINE EXCEPTION' ) == 2 and 'other' in out, out
+        assert 'repeated 899 times' in out, out
+        assert '101 more coroutine exceptions dropped' in out, out
+
+        sink.close()
+        assert sink.thread is None and sink not in exceptionsink.liveSinks
+
+
+    def run( self ):
+        self.scheduler.newTask( self.coTest() )
+
+
+
+class StallWatchdogTest( Test ):
+    def run( self ):
+        def blockingCall():
+            time.sleep( 0.2 )
+
+
+        def blocker():
+            yield
+            blockingCall()
+
+
+        def coTest( scheduler ):
+            watchdog = StallWatchdog( scheduler, datetime.timedelta(milliseconds = 50) )
+            watchdog.start()
+            try:
+                t = scheduler.newTask( blocker() )
+                yield WaitTask( t )
+            finally:
+                watchdog.stop()
+
+            assert len( watchdog.records ) == 1
+            record = watchdog.records[ 0 ]
+            assert record.duration >= datetime.timedelta( milliseconds = 50 )
+            assert 'blockingCall' in [ e[2] for e in record.threadStack ]
+            assert record.coroutineStack[ -1 ][ 2 ] == 'blocker'
+
+
+        self.scheduler.newTask( coTest(self.scheduler) )
+
+
+
+class DumpTest( Test ):
+    def run( self ):
+        def sleeper():
+            yield Sleep( 50 )
+
+
+        def coTest( scheduler ):
+            tasks = [ scheduler.newTask( sleeper() ) for i in xrange( 5 ) ]
+            waiter = scheduler.newTask( coWaitTasks(list(tasks), 500) )
+            yield
+
+            assert len( scheduler.registry ) == 7
+            assert scheduler.waitSummary() == { 'Sleep': 5, 'WaitFirstTask': 1 }
+
+            sleeping = scheduler.dump( Sleep )
+            assert sorted( e['tid'] for e in sleeping ) == sorted( t.tid for t in tasks )
+            assert sleeping[ 0 ][ 'state' ] == 'waiting'
+            assert sleeping[ 0 ][ 'stack' ][ -1 ][ 2 ] == 'sleeper'
+
+            me = [ e for e in scheduler.dump() if e['state'] == 'running' ]
+            assert me[ 0 ][ 'stack' ][ -1 ][ 2 ] == 'coTest'
+            assert 'WaitFirstTask' in scheduler.formatDump( 'WaitFirstTask' )
+
+            yield WaitTask( waiter )
+            assert len( scheduler.registry ) == 1
+
+
+        self.scheduler.newTask( coTest(self.scheduler) )
+
+
+
+class AdmissionTest( Test ):
+    def run( self ):
+        def sleeper( test ):
+            test.running += 1
+            test.maxRunning = max( test.maxRunning, test.running )
+            yield Sleep( 20 )
+            test.running -= 1
+
+
+        def coTest( scheduler, test ):
+            test.running = test.maxRunning = 0
+            queued = []
+            scheduler.admissionQueueChanged.connect( queued.append )
+
+            # coTest takes one slot too
+            scheduler.setAdmissionLimit( 3, Scheduler.ADMIT_QUEUE, 3 )
+            try:
+                tasks = [ scheduler.newTask( sleeper(test) ) for i in xrange( 5 ) ]
+                assert [ t.state for t in tasks ].count( Task.NEW ) == 3
+                assert queued[ -1 ] == 3
+                try:
+                    scheduler.newTask( sleeper(test) )
+                    assert False
+                except AdmissionRejected:
+                    assert scheduler.rejectedCount == 1
+
+                assert [ e['state'] for e in scheduler.dump() ].count( 'queued' ) == 3
+                yield coWaitTasks( tasks, 500 )
+                assert test.maxRunning == 2
+                assert queued[ -1 ] == 0
+
+                # drop oldest
+                scheduler.setAdmissionLimit( 3, Scheduler.ADMIT_DROP_OLDEST, 1 )
+                tasks = []
+                for i in xrange( 4 ):
+                    t = scheduler.newTask( sleeper(test) )
+                    t.setEmitUnhandled()
+                    tasks.append( t )
+
+                assert scheduler.droppedCount == 1
+                assert tasks[ 2 ].state == Task.EXCEPTION
+                try:
+                    yield WaitTask( tasks[2] )
+                    assert False
+                except AdmissionDropped:
+                    pass
+                yield coWaitTasks( tasks, 500 )
+            finally:
+                scheduler.setAdmissionLimit( None )
+
+
+        self.scheduler.newTask( coTest(self.scheduler, self) )
+
+
+
+class MetricsTest( Test ):
+    def run( self ):
+        def sleeper( ms ):
+            yield Sleep( ms )
+            yield
+
+
+        # func() result outside of scheduler ticks
+        def betweenTicks( func ):
+            f = Future()
+            QTimer.singleShot( 0, lambda: f.setResult(func()) )
+            return f
+
+
+        def coTest( scheduler ):
+            metrics = scheduler.metrics
+            yield betweenTicks( metrics.reset )
+
+            tasks = [ scheduler.newTask( sleeper(i) ) for i in xrange( 10 ) ]
+            yield coWaitTasks( tasks, 500 )
+
+            # every step of ended ticks is counted once
+            waits, steps = yield betweenTicks( lambda: (metrics.waitToRun.count, metrics.stepsPerTick.sum) )
+            assert waits == steps, (waits, steps)
+            # 3 steps of each sleeper
+            assert steps >= 30, steps
+
+            assert metrics.lag.count
+            assert metrics.readyDepth.count == metrics.lag.count
+            assert metrics.snapshot()[ 'tasks' ] == scheduler.tasks
+
+            server = MetricsServer( metrics )
+            try:
+                text = urllib2.urlopen( 'http://127.0.0.1:%d/metrics' % server.port ).read()
+            finally:
+                server.stop()
+
+            assert 'pyqtcoroutines_event_loop_lag_seconds_count' in text
+            assert 'pyqtcoroutines_ready_queue_depth_bucket{le="+Inf"}' in text
+            assert 'pyqtcoroutines_tasks ' in text
+
+
+        self.scheduler.newTask( coTest(self.scheduler) )
+
+
+
 # TODO:)...
 class ReturnValueTest( Test ):
     pass
@@ -447,10 +1599,33 @@ if __name__ == '__main__':
     tester = Tester( s )
     tester.addTest( SleepTest(s) )
     tester.addTest( SpeedTest(s, 1) )
+    tester.addTest( FairShareTest(s) )
     tester.addTest( SpeedTest(s, 100) )
+    tester.addTest( CheckpointSpeedTest(s, 1) )
+    tester.addTest( CheckpointSpeedTest(s, 100) )
+    tester.addTest( ChurnSpeedTest(s) )
     tester.addTest( AsyncCallTest(s) )
     tester.addTest( WaitTaskTest(s) )
+    tester.addTest( InlineWaitSpeedTest(s) )
+    tester.addTest( WakeupLatencyTest(s) )
     tester.addTest( WaitFirstTaskTest(s) )
+    tester.addTest( WaitSignalTest(s) )
+    tester.addTest( PeriodicTest(s) )
+    tester.addTest( FutureTest(s) )
+    tester.addTest( CancelTest(s) )
+    tester.addTest( HedgeTest(s) )
+    tester.addTest( ParallelTest(s) )
+    tester.addTest( SingleFlightTest(s) )
+    tester.addTest( MetricsTest(s) )
+    tester.addTest( ThreadsafeScheduleTest(s) )
+    tester.addTest( HttpClientTest(s) )
+    tester.addTest( FileStreamTest(s) )
+    tester.addTest( StallWatchdogTest(s) )
+    tester.addTest( DumpTest(s) )
+    tester.addTest( TracerTest(s) )
+    tester.addTest( MemoryProfileTest(s) )
+    tester.addTest( ExceptionSinkTest(s) )
+    tester.addTest( AdmissionTest(s) )
 
     prof = hotshot.Profile("coroutines.prof")
     prof.runcall( a.exec_ )
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Scheduling trace recorder: fixed size binary records in a ring buffer,
+# offline conversion to Chrome trace / Perfetto JSON.
+#
+# Does not import qt, so the converter runs anywhere:
+#   python tracer.py app.trace > app.json
+#
+# GNU LGPL v. 2.1
+
+import sys
+import json
+import struct
+try:
+    # the scheduler clock
+    from coroutines import monotonic
+except ImportError:
+    # no qt, converter only
+    monotonic = None
+
+
+# Record events
+TRACE_SPAWN = 1       # aux - parent task tid or 0
+TRACE_SCHEDULE = 2    # task is ready
+TRACE_RESUME = 3      # task step starts
+TRACE_SUSPEND = 4     # task parked on AsynchronousCall, aux - call type name id
+TRACE_WAKEUP = 5      # aux - waking task tid or 0
+TRACE_DONE = 6        # aux - Task state
+
+EVENT_NAMES = { TRACE_SPAWN: 'spawn', TRACE_SCHEDULE: 'schedule', TRACE_RESUME: 'resume',
+                TRACE_SUSPEND: 'suspend', TRACE_WAKEUP: 'wakeup', TRACE_DONE: 'done' }
+
+
+# timestamp, event, tid, aux
+RECORD = struct.Struct( '<dBII' )
+
+
+# magic, version, record size, capacity, records written
+HEADER = struct.Struct( '<4sHHIQ' )
+TRACE_MAGIC = 'PQTR'
+TRACE_VERSION = 1
+
+
+# Default ring buffer capacity, records
+TRACE_CAPACITY = 64 * 1024
+
+
+
+# Records scheduling events of one Scheduler.
+# Keeps the last capacity records.
+#
+# Usage:
+#   tracer = TraceRecorder()
+#   tracer.attach( scheduler )
+#   ...
+#   tracer.detach()
+#   tracer.save( 'app.trace' )
+class TraceRecorder( object ):
+    def __init__( self, capacity = TRACE_CAPACITY ):
+        self.capacity = capacity
+        self.buffer = bytearray( capacity * RECORD.size )
+        self.count = 0            # records written, may be > capacity
+        self.names = [ '' ]       # call type names, aux of TRACE_SUSPEND
+        self.nameIds = {}         # call type -> name id
+        self.scheduler = None
+        self.pack = RECORD.pack_into
+
+
+    def attach( self, scheduler ):
+        self.scheduler = scheduler
+        scheduler.tracer = self
+
+
+    def detach( self ):
+        if self.scheduler is not None:
+            self.scheduler.tracer = None
+            self.scheduler = None
+
+
+    def record( self, event, tid, aux = 0, now = None ):
+        if now is None:
+            now = monotonic()
+        self.pack( self.buffer, (self.count % self.capacity) * RECORD.size, now, event, tid, aux )
+        self.count += 1
+
+
+    def nameId( self, cls ):
+        i = self.nameIds.get( cls )
+        if i is None:
+            i = self.nameIds[ cls ] = len( self.names )
+            self.names.append( cls.__name__ )
+        return i
+
+
+    # Scheduler hooks
+    def spawn( self, task, parent ):
+        self.record( TRACE_SPAWN, task.tid, parent and parent.tid or 0, task.created )
+
+
+    def schedule( self, task, now ):
+        self.record( TRACE_SCHEDULE, task.tid, 0, now )
+
+
+    def resume( self, task, now ):
+        self.record( TRACE_RESUME, task.tid, 0, now )
+
+
+    def suspend( self, task, call ):
+        self.record( TRACE_SUSPEND, task.tid, self.nameId(type(call)) )
+
+
+    def wakeup( self, task, waker ):
+        self.record( TRACE_WAKEUP, task.tid, waker and waker.tid or 0 )
+
+
+    def done( self, task ):
+        self.record( TRACE_DONE, task.tid, task.state )
+
+
+    # [ (timestamp, event, tid, aux), .. ] oldest first
+    def records( self ):
+        n = min( self.count, self.capacity )
+        first = self.count - n
+        return [ RECORD.unpack_from(self.buffer, ((first + i) % self.capacity) * RECORD.size)
+                 for i in xrange( n ) ]
+
+
+    def save( self, path ):
+        f = open( path, 'wb' )
+        try:
+            f.write( HEADER.pack(TRACE_MAGIC, TRACE_VERSION, RECORD.size, self.capacity, self.count) )
+            writeNames( f, self.names )
+            for r in self.records():
+                f.write( RECORD.pack(*r) )
+        finally:
+            f.close()
+
+
+    def __repr__( self ):
+        return 'TraceRecorder( %d of %d records )' % (min(self.count, self.capacity), self.capacity)
+
+
+
+def writeNames( f, names ):
+    f.write( struct.pack('<I', len(names)) )
+    for name in names:
+        name = name.encode( 'utf-8' )
+        f.write( struct.pack('<H', len(name)) + name )
+
+
+
+def readNames( f ):
+    names = []
+    count, = struct.unpack( '<I', f.read(4) )
+    for i in xrange( count ):
+        size, = struct.unpack( '<H', f.read(2) )
+        names.append( f.read( size ).decode('utf-8') )
+    return names
+
+
+
+# Returns (names, records, lost records)
+def loadTrace( path ):
+    f = open( path, 'rb' )
+    try:
+        magic, version, size, capacity, count = HEADER.unpack( f.read(HEADER.size) )
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or size != RECORD.size:
+            raise ValueError( '%s: not a trace file' % path )
+
+        names = readNames( f )
+        data = f.read()
+    finally:
+        f.close()
+
+    records = [ RECORD.unpack_from(data, i) for i in xrange(0, len(data) - RECORD.size + 1, RECORD.size) ]
+    return names, records, count - len( records )
+
+
+
+# Chrome trace event format, one thread per task:
+# run, ready and waiting (named by call type) slices.
+def chromeTrace( names, records ):
+    events = []
+    if not records:
+        return { 'traceEvents': events }
+
+    start = records[ 0 ][ 0 ]
+    us = lambda t: (t - start) * 1e6
+    # tid -> (state, since, name)
+    states = {}
+
+
+    def close( tid, now ):
+        state = states.pop( tid, None )
+        if state is not None:
+            kind, since, name = state
+            events.append( { 'name': name, 'cat': kind, 'ph': 'X', 'pid': 1, 'tid': tid,
+                             'ts': us(since), 'dur': us(now) - us(since) } )
+        return state
+
+
+    for now, event, tid, aux in records:
+        if event == TRACE_SPAWN:
+            events.append( { 'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                             'args': { 'name': 'task %d' % tid } } )
+            events.append( { 'name': 'spawn', 'ph': 'i', 's': 't', 'pid': 1, 'tid': tid,
+                             'ts': us(now), 'args': { 'parent': aux } } )
+
+        elif event == TRACE_SCHEDULE:
+            # requeued after yield or woken up
+            if states.get( tid, ('', ) )[ 0 ] != 'ready':
+                close( tid, now )
+                states[ tid ] = ( 'ready', now, 'ready' )
+
+        elif event == TRACE_RESUME:
+            close( tid, now )
+            states[ tid ] = ( 'run', now, 'run' )
+
+        elif event == TRACE_SUSPEND:
+            name = aux < len( names ) and names[ aux ] or '?'
+            if states.get( tid, ('', ) )[ 0 ] == 'ready':
+                # woken up inside handle(), before the step was over
+                events.append( { 'name': name, 'ph': 'i', 's': 't', 'pid': 1, 'tid': tid, 'ts': us(now) } )
+                continue
+
+            close( tid, now )
+            states[ tid ] = ( 'wait', now, name )
+
+        elif event == TRACE_WAKEUP:
+            if states.get( tid, ('', ) )[ 0 ] == 'wait':
+                close( tid, now )
+            events.append( { 'name': 'wakeup', 'ph': 'i', 's': 't', 'pid': 1, 'tid': tid,
+                             'ts': us(now), 'args': { 'by': aux } } )
+
+        elif event == TRACE_DONE:
+            close( tid, now )
+            events.append( { 'name': 'done', 'ph': 'i', 's': 't', 'pid': 1, 'tid': tid,
+                             'ts': us(now), 'args': { 'state': aux } } )
+
+    # still running or waiting at the end
+    end = records[ -1 ][ 0 ]
+    for tid in states.keys():
+        close( tid, end )
+
+    return { 'traceEvents': events, 'displayTimeUnit': 'ms' }
+
+
+
+if __name__ == '__main__':
+    if len( sys.argv ) not in ( 2, 3 ):
+        sys.stderr.write( 'Usage: %s app.trace [app.json]\n' % sys.argv[0] )
+        sys.exit( 2 )
+
+    names, records, lost = loadTrace( sys.argv[1] )
+    if lost:
+        sys.stderr.write( '%d oldest records were overwritten\n' % lost )
+
+    out = len( sys.argv ) == 3 and open( sys.argv[2], 'w' ) or sys.stdout
+    json.dump( chromeTrace(names, records), out )
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Live stall watchdog for the Scheduler.
+#
+# GNU LGPL v. 2.1
+
+import sys
+import datetime
+import threading
+import traceback
+from collections import deque
+from PyQt4.QtCore import QObject, pyqtSignal
+from coroutines import monotonic
+
+
+# Task step is stalled, when it runs longer
+STALL_THRESHOLD = datetime.timedelta( milliseconds = 200 )
+
+
+# Keep last N StallRecords
+MAX_STALL_RECORDS = 100
+
+
+
+class StallRecord( object ):
+    def __init__( self, task, duration, threadStack, coroutineStack ):
+        self.time = datetime.datetime.now()
+        self.task = repr( task )
+        self.duration = duration               # timedelta, when captured
+        self.threadStack = threadStack         # traceback.extract_stack() of the scheduler thread
+        self.coroutineStack = coroutineStack   # Task.coroutineStack()
+
+
+    def __repr__( self ):
+        res = 'STALL %s: %s blocks scheduler for %s\n' % (self.time, self.task, self.duration)
+        res += 'Coroutines stack:\n'
+        res += ''.join( '  File "%s", line %d, in %s\n' % e for e in self.coroutineStack )
+        res += 'Scheduler thread stack:\n'
+        res += ''.join( traceback.format_list(self.threadStack) )
+        return res
+
+
+    def __str__( self ):
+        return self.__repr__()
+
+
+
+# Samples scheduler thread from the own thread.
+# When Task.run step runs longer than threshold,
+# captures thread and coroutines stacks, while task still blocks.
+#
+# Usage:
+#   watchdog = StallWatchdog( scheduler )
+#   watchdog.stalled.connect( log )   # delivered, when qt loop is alive again
+#   watchdog.start()
+class StallWatchdog( QObject ):
+    stalled = pyqtSignal( object )
+
+    def __init__( self, scheduler, threshold = STALL_THRESHOLD, parent = None ):
+        QObject.__init__( self, parent )
+        self.scheduler = scheduler
+        self.threshold = threshold.total_seconds()
+        self.records = deque( maxlen = MAX_STALL_RECORDS )
+        self.stopped = threading.Event()
+        self.thread = None
+
+
+    def start( self ):
+        assert self.thread is None
+
+        self.stopped.clear()
+        self.thread = threading.Thread( target = self.watch, name = 'StallWatchdog' )
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop( self ):
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+
+    # watchdog thread
+    def watch( self ):
+        reported = None
+        while not self.stopped.wait( self.threshold / 4 ):
+            step = self.scheduler.step
+            if step is None or step is reported:
+                continue
+
+            started, task = step
+            elapsed = monotonic() - started
+            if elapsed < self.threshold:
+                continue
+
+            frame = sys._current_frames().get( self.scheduler.threadId )
+            # step is over?
+            if frame is None or self.scheduler.step is not step:
+                continue
+
+            reported = step
+            threadStack = traceback.extract_stack( frame )
+            del frame
+            try:
+                coroutineStack = task.coroutineStack()
+            except Exception:
+                # stack changes under our feet
+                coroutineStack = []
+
+            record = StallRecord( task, datetime.timedelta(seconds = elapsed), threadStack, coroutineStack )
+            self.records.append( record )
+            self.stalled.emit( record )